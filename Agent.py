@@ -5,6 +5,11 @@ Defines the `Individual` agent class for use in an agent-based model (ABM) simul
 Agents represent individuals responding to environmental threats, social cues, and risk communication.
 The simulation models decision-making with respect to evacuation and protective actions.
 
+An agent only holds scalars and integer indices: survey and media rows, the tract and its node in the
+acquaintance graph. Everything that is equal for many agents (survey tables, cues, the acquaintance operator
+and the neighbour table) is kept once by the model and looked up through these indices, and the attributes
+are stored in __slots__, so a large population fits in the memory of one worker.
+
 Dependencies:
     - mesa.Agent: agent-based modeling framework
     - numpy: numerical operations
@@ -14,32 +19,36 @@ Dependencies:
 from mesa import Agent
 import numpy as np
 import warnings
+from Population import ACTIONS
 
 warnings.filterwarnings("ignore")
 
 
 class Individual(Agent):
-    def __init__(self, model,factor_values,weight_values,media_values,wind, rain,storm_surge):  # ,pos):
+    # mesa's Agent keeps model, unique_id and pos in the instance dict, all other attributes live in slots
+    __slots__ = ("survey_row", "media_row", "tract", "rain_cue", "wind_cue", "storm_surge_state",
+                 "risk_perception", "evac_friends", "evac_hotel", "evac_shelter", "stay", "preferred_evac",
+                 "phase", "immediacy", "immediacy_cum", "immediacy_base", "media_cue", "cue_perception",
+                 "social_perception", "RI_thresh", "RA_thresh", "env_weight", "n_acquaintances")
+
+    def __init__(self, model,tract,survey_row,media_row):  # ,pos):
         super().__init__(model)
 
-        self.factor_values = factor_values # Factors used as input for logistic model
-        self.weight_values = weight_values # Weights used for determinign RA threshold
+        self.survey_row = survey_row # Row of the respondent in the survey predictor and weight tables
+        weight_values = self.model.survey["weights"][survey_row] # Weights used for determinign RA threshold
 
-        # Survey data for Usage frequency and trust of media, used for media cue
-        self.media_values = media_values
-        self.media_trust = np.array([self.model.media_weight_trust * x for x in media_values.iloc[:, :-5].values[0]])
-        self.media_freq = media_values.iloc[:, :5].values[0]
+        # Row in the survey media table, usage frequency and trust of media are used for media cue
+        self.media_row = media_row
 
-        # Gets acquaintances for Watts Strogatz graph
-        self.acquaintances = self.model.grid.get_neighbors(self.unique_id - 1)
+        # Number of acquaintances in the Watts Strogatz graph, the agents themselves are looked up when needed
+        indptr = self.model.acquaintances.indptr
+        self.n_acquaintances = int(indptr[self.unique_id] - indptr[self.unique_id - 1])
 
-        self.rain = rain # Rain cue list
-        self.wind = wind # Wind cue list
-        self.storm_surge = storm_surge # Storm surge state list
+        self.tract = tract # Tract index, used to look up the cues of the living area in the model
 
-        self.rain_cue = rain[self.model.steps] # Current wind cue value
-        self.wind_cue = wind[self.model.steps] # Current rain cue value
-        self.storm_surge_state = storm_surge[self.model.steps] # Current Storm surge cue value
+        self.rain_cue = self.model.rain[tract, self.model.steps] # Current wind cue value
+        self.wind_cue = self.model.wind[tract, self.model.steps] # Current rain cue value
+        self.storm_surge_state = self.model.storm_surge[tract, self.model.steps] # Current Storm surge cue value
 
        # Starting values for attributes, without errors occur due communication methods
         self.risk_perception = 0
@@ -50,7 +59,6 @@ class Individual(Agent):
         self.phase = 0
         self.immediacy_cum = 0
         self.immediacy_base = 0
-        self.neigh_individuals = None # Gets assigned in model.py
         self.media_cue = 0
         self.cue_perception = 0
         self.social_perception = 0
@@ -65,14 +73,35 @@ class Individual(Agent):
     def __str__(self):
         return f"{self.age} old, {self.edu}, {self.income}, {self.car}, {self.race}"
 
+    @property
+    def acquaintances(self):
+        """
+        Acquaintances of the agent in the Watts Strogatz graph, looked up in the acquaintance operator of the
+        model. Only acquaintances placed before the agent are included, as found on the NetworkGrid. Acquaintances
+        that implemented a protective action are left out once the model has pruned them.
+        """
+        operator = self.model.acquaintances
+        node = self.unique_id - 1
+        individuals = self.model.individuals
+        return [individuals[j] for j in operator.indices[operator.indptr[node]:operator.indptr[node + 1]]]
+
+    @property
+    def neigh_individuals(self):
+        """Closest physical neighbours of the agent, looked up in the neighbour operator of the model. Like the
+        acquaintances, neighbours that left are left out once the model has pruned them."""
+        operator = self.model.neighbours
+        node = self.unique_id - 1
+        individuals = self.model.individuals
+        return [individuals[j] for j in operator.indices[operator.indptr[node]:operator.indptr[node + 1]]]
+
 
     def general_communication(self, attribute):
         """
         Update own attribute (e.g., risk perception) by averaging with acquaintances.
        The value in coeff_dict determines the strength of acquaintances.
         """
-        if len(self.acquaintances) != 0:
-            comm_sum = sum([getattr(self, attribute) for i in self.acquaintances]) / len(self.acquaintances)
+        if self.n_acquaintances != 0:
+            comm_sum = sum([getattr(self, attribute) for i in range(self.n_acquaintances)]) / self.n_acquaintances
             own = getattr(self, attribute)
             avg = (own + comm_sum) / 2
             diff = own - avg
@@ -95,7 +124,7 @@ class Individual(Agent):
         change (heightened risk awareness or action signal).
         """
         # print(f"Agent{self.unique_id}")
-        if len(self.acquaintances) != 0:
+        if self.n_acquaintances != 0:
             # print(f"Agent {self.unique_id} reaches out to: Agent {[x.unique_id for x in self.acquaintances]}")
             for agent in self.acquaintances:
                 # print(f"Perception Agent {agent.unique_id} before: {agent.social_perception}")
@@ -117,9 +146,9 @@ class Individual(Agent):
         Update the agent's media cue variable based on frequency and trust toward media.
         Increments media_cue if exposed at this timestep.
         """
-        media_comm = [1 if self.model.steps % medium == 0 else 0 for medium in self.media_freq]
+        media_comm = [1 if self.model.steps % medium == 0 else 0 for medium in self.model.media_freq[self.media_row]]
         # print(media_comm)
-        raw_increment = sum(self.media_trust * media_comm) / 5
+        raw_increment = sum(self.model.media_trust[self.media_row] * media_comm) / 5
         if self.media_cue + raw_increment < 1:
             self.media_cue += raw_increment
         else:
@@ -135,7 +164,7 @@ class Individual(Agent):
         if self.risk_perception >= self.RI_thresh:
             # print(f"Agent {self.unique_id} communicates phase {self.phase} change!")
             self.phase_change_communication(1)
-            self.phase = 1
+            self.change_phase(1)
             # print(f"Agent {self.unique_id} new phase is {self.phase}! \n")
 
     def risk_assessment(self):
@@ -149,7 +178,7 @@ class Individual(Agent):
             # print(f"Agent {self.unique_id} communicates phase {self.phase} change!")
             self.phase_change_communication(2)
             self.protective_action_search()
-            self.phase = 2
+            self.change_phase(2)
             # print(f"Agent {self.unique_id} new phase is {self.phase}! \n")
         else:
             self.general_communication("risk_perception")
@@ -158,15 +187,13 @@ class Individual(Agent):
     def protective_action_search(self):
         """
         Use the multinominal logistic regression determined in regression models/Statistics1.ipynb to determine the
-        probabilities of each protective action and record the preferred option.
+        probabilities of each protective action and record the preferred option. The probabilities are computed for
+        the whole population when the model is created, the agent reads its own row. The preferred option is the
+        first option with the highest probability.
         """
-        self.evac_friends, self.evac_hotel, self.evac_shelter, self.stay = self.model.logistic_model.predict_proba(self.factor_values)[0]
-        self.evac_values = {
-            'evac_friends': self.evac_friends,
-            'evac_hotel': self.evac_hotel,
-            'evac_shelter': self.evac_shelter,
-            'stay': self.stay}
-        self.preferred_evac = max(self.evac_values, key=self.evac_values.get)
+        probabilities = self.model.action_probabilities[self.unique_id - 1]
+        self.evac_friends, self.evac_hotel, self.evac_shelter, self.stay = probabilities
+        self.preferred_evac = ACTIONS[int(np.argmax(probabilities))]
 
 
     def protective_action_assessment(self):
@@ -182,10 +209,10 @@ class Individual(Agent):
         prob_action = min(1, prob_action)
         prob_action += self.immediacy
         if prob_action > self.model.min_probability_threshold:
-            if self.random.random() < prob_action:
+            if self.model.decision_draws() < prob_action:
               # print(f"Agent {self.unique_id} will implement the {self.preferred_evac} action!")
                 self.Protective_Action_Implementation_communication()
-                self.phase = 3
+                self.change_phase(3)
                 self.model.evaced_agents += 1
                 if self.preferred_evac == "evac_hotel":
                     self.model.hotel_choice += 1
@@ -225,6 +252,11 @@ class Individual(Agent):
                 agent.evac_shelter += self.model.action_comm_value
                 agent.immediacy_cum += self.model.action_comm_value_imm
 
+    def change_phase(self, phase):
+        """Moves the agent to another phase and reports it to the scheduler, which counts the agents per phase."""
+        self.model.scheduler.move(self, self.phase, phase)
+        self.phase = phase
+
     def step(self):
         """
         Primary timestep update function for the agent, orchestrating transitions between
@@ -237,16 +269,15 @@ class Individual(Agent):
         is in and communicate risk perception.
         """
         self.risk_perception = min(self.cue_perception + self.social_perception, 1)
-        self.immediacy_base = self.model.ceiling * ((self.model.steps + 1) * (1 / self.model.number_of_steps)) / (
-                    1 + self.model.grow_factor * (1 - (self.model.steps + 1) * (1 / self.model.number_of_steps)))
+        self.immediacy_base = self.model.scheduler.immediacy_base # Equal for all agents, computed once per step
         n_steps = self.model.steps
 
-        self.rain_cue = self.rain[n_steps-1]
+        self.rain_cue = self.model.rain[self.tract, n_steps-1]
         self.calc_media_cue()
         if n_steps % 3 == 0:
 
             old_value = self.storm_surge_state
-            self.storm_surge_state = self.storm_surge[int(n_steps / 3)+1]
+            self.storm_surge_state = self.model.storm_surge[self.tract, int(n_steps / 3)+1]
             if old_value == 0:
                 if  self.storm_surge_state == 0.5:
                     self.social_perception += self.model.comm_watch_value_risk
@@ -259,14 +290,11 @@ class Individual(Agent):
                     self.social_perception += self.model.comm_watch_value_risk
                     self.immediacy_cum += self.model.comm_warning_value_imm
         if n_steps % 3 == 0:
-            self.wind_cue = self.wind[(int(n_steps / 3))-1]
-        phase_methods = {
-            0: self.risk_identification,
-            1: self.risk_assessment,
-            2: self.protective_action_assessment,
-        }
-        # Get the method for the current phase and call it
-        method = phase_methods.get(self.phase)
-        if method:
-            method()
+            self.wind_cue = self.model.wind[self.tract, (int(n_steps / 3))-1]
+        # Get the method for the current phase and call it, agents that left are not stepped
+        PHASE_METHODS[self.phase](self)
         self.general_communication("risk_perception")
+
+
+# Method of every phase, indexed by the phase of the agent
+PHASE_METHODS = (Individual.risk_identification, Individual.risk_assessment, Individual.protective_action_assessment)
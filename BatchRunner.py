@@ -0,0 +1,509 @@
+"""
+BatchRunner.py
+
+Parallel batch runner for the `EvacuationDec` model. Compared to mesa's batch_run it:
+    - Loads the read only inputs once in the parent process and places them in shared memory: the survey
+      tables, the tract cue tensors and polygons, and the coefficients and action probabilities of the
+      logistic model. Workers map these blocks instead of reading and unpickling the files again.
+    - Sends the runs to the workers in chunks of (parameter set, seed) jobs.
+    - Returns the collected data of a run as compact arrays instead of lists of dicts.
+    - Records every completed run in a ledger, so an interrupted sweep continues where it stopped.
+    - Can stop starting replicates of a parameter combination once its metrics have converged.
+    - Compares policy scenarios against a base with paired replicates (common random numbers, antithetic
+      decisions and a balanced survey bootstrap) and reports the variance of the differences.
+
+Dependencies:
+    - numpy: numerical operations
+    - pandas: summary of adaptive sweeps
+    - scikit-learn: rebuilding the logistic model from the shared coefficients
+    - scipy: quantiles of the t distribution
+    - OnlineStats: running statistics of adaptive sweeps
+    - helper_functions: input loaders
+"""
+
+import contextlib
+import functools
+import itertools
+import json
+import os
+from multiprocessing import Pool, shared_memory
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.linear_model import LogisticRegression
+from tqdm.auto import tqdm
+import helper_functions
+from OnlineStats import OnlineStats
+from helper_functions import (load_columns, load_logistic_model, survey_action_probabilities, survey_data,
+                              tract_data)
+
+# Shared memory blocks attached by a worker, kept referenced for the lifetime of the worker
+_attached = []
+
+
+class SharedInputs:
+    """
+    The read only model inputs, copied once into shared memory blocks. Use as a context manager, the blocks
+    are removed when the runner is done.
+    """
+
+    def __init__(self, state="Florida", county="Miami-Dade County"):
+        """
+        Args:
+            state (str): State of the tract data.
+            county (str): County of the tract data.
+        """
+        survey = survey_data()
+        logistic_model = load_logistic_model()
+        tract_key = f"{[state]}{[county]}" # Same folder name as tract_data([state], [county])
+        arrays = {
+            "survey.predictors": survey["predictors"],
+            "survey.weights": survey["weights"],
+            "survey.media": survey["media"],
+            "action_probabilities": survey_action_probabilities(),
+            "logistic.coef_": logistic_model.coef_,
+            "logistic.intercept_": logistic_model.intercept_,
+            "logistic.classes_": logistic_model.classes_,
+        }
+        tracts = tract_data([state], [county])
+        arrays.update({f"tracts.{name}": values for name, values in tracts.items()})
+
+        self.blocks = []
+        self.spec = {}
+        for name, values in arrays.items():
+            values = np.ascontiguousarray(values)
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+            self.blocks.append(block)
+            self.spec[name] = (block.name, values.shape, values.dtype.str)
+        self.meta = {
+            "predictor_columns": survey["predictor_columns"],
+            "logistic_params": logistic_model.get_params(),
+            "feature_names_in_": list(getattr(logistic_model, "feature_names_in_", [])),
+            "tract_key": tract_key,
+        }
+
+    def close(self):
+        """Releases and removes the shared memory blocks."""
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_shared_inputs(spec, meta):
+    """
+    Pool initializer. Maps the shared memory blocks as read only arrays and installs them in
+    helper_functions.shared_inputs, where the loaders of the model pick them up.
+
+    Args:
+        spec (dict): Name to (block name, shape, dtype) of every shared array.
+        meta (dict): The non array inputs, see SharedInputs.
+    """
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _attached.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        arrays[name].flags.writeable = False
+
+    logistic_model = LogisticRegression(**meta["logistic_params"])
+    for name in ("coef_", "intercept_", "classes_"):
+        setattr(logistic_model, name, arrays[f"logistic.{name}"])
+    logistic_model.n_features_in_ = arrays["logistic.coef_"].shape[1]
+    if meta["feature_names_in_"]:
+        logistic_model.feature_names_in_ = np.array(meta["feature_names_in_"], dtype=object)
+
+    helper_functions.shared_inputs.update({
+        "survey": {
+            "predictors": arrays["survey.predictors"],
+            "predictor_columns": meta["predictor_columns"],
+            "weights": arrays["survey.weights"],
+            "media": arrays["survey.media"],
+        },
+        "logistic_model": logistic_model,
+        "action_probabilities": arrays["action_probabilities"],
+        ("tracts", meta["tract_key"]): {name[len("tracts."):]: values for name, values in arrays.items()
+                                        if name.startswith("tracts.")},
+    })
+    # Loaders that already ran in the parent before forking must not return their own copies
+    for loader in (survey_data, load_logistic_model, survey_action_probabilities):
+        loader.cache_clear()
+
+
+def make_runs(parameters, iterations=1, seed=None):
+    """
+    Expands the parameters into the runs of a sweep, in the same order as mesa's batch_run.
+
+    Args:
+        parameters (dict or list of dict): Model parameters, single values or iterables of values to combine,
+            or a list of parameter sets that are run as given (e.g. the points of an experimental design).
+        iterations (int): Number of iterations for each parameter combination.
+        seed (int, optional): Seed the run seeds are drawn from. Random seeds are used if None.
+
+    Returns:
+        list: (RunId, iteration, parameters, seed) of every run. Run r belongs to combination
+        r % (number of combinations).
+    """
+    if isinstance(parameters, dict):
+        values = [[(name, value)] if isinstance(value, str) or not hasattr(value, "__iter__")
+                  else [(name, v) for v in value] for name, value in parameters.items()]
+        combinations = [dict(kwargs) for kwargs in itertools.product(*values)]
+    else:
+        combinations = [dict(kwargs) for kwargs in parameters]
+    runs = list(itertools.product(range(iterations), combinations))
+    seeds = np.random.SeedSequence(seed).generate_state(len(runs)).tolist()
+    return [(run_id, iteration, kwargs, run_seed)
+            for run_id, ((iteration, kwargs), run_seed) in enumerate(zip(runs, seeds))]
+
+
+def read_ledger(path):
+    """
+    Reads the ledger of a sweep. The first line holds the seed of the sweep, every following line a
+    completed run.
+
+    Returns:
+        tuple: Seed of the sweep (None if the ledger does not exist yet) and the set of completed RunIds.
+    """
+    if path is None or not os.path.isfile(path):
+        return None, set()
+    with open(path) as file:
+        lines = [json.loads(line) for line in file if line.strip()]
+    return lines[0]["seed"], {line["RunId"] for line in lines[1:]}
+
+
+def _run_chunk(model_cls, agents, chunk):
+    """Runs a chunk of jobs in a worker and returns the output of every run as compact arrays."""
+    results = []
+    for run_id, iteration, kwargs, seed in chunk:
+        model = model_cls(**{"seed": seed, **kwargs}) # A seed in the parameters takes precedence
+        while model.running:
+            model.step()
+        collector = model.datacollector
+        results.append({
+            "RunId": run_id,
+            "iteration": iteration,
+            "params": kwargs,
+            "seed": seed,
+            "columns": collector.model_columns(),
+            "agent_columns": collector.agent_columns() if agents else None,
+        })
+    return results
+
+
+@contextlib.contextmanager
+def worker_pool(model_cls, agents, number_processes=None, state="Florida", county="Miami-Dade County",
+                cache=None):
+    """
+    Starts the workers of a sweep and places the model inputs in shared memory for them.
+
+    Args:
+        model_cls: The model class to run.
+        agents (bool): Also return the agent reporters of every run.
+        number_processes (int, optional): Number of processes, None uses all CPUs and 1 runs in this process.
+        state (str): State of the tract data placed in shared memory.
+        county (str): County of the tract data placed in shared memory.
+        cache (ResultCache, optional): Runs found in the cache are returned without running them, the other
+            runs are added to it. The cache is only accessed by this process.
+
+    Yields:
+        function: Takes a list of (RunId, iteration, parameters, seed) jobs and an optional chunk size, and
+        yields the result of every run as soon as its chunk finishes.
+    """
+    processes = number_processes or os.cpu_count()
+    process_func = functools.partial(_run_chunk, model_cls, agents)
+
+    def run_chunks(map_chunks, runs, chunksize=None):
+        descriptions = {}
+        if cache is not None:
+            misses = []
+            for run_id, iteration, kwargs, seed in runs:
+                content = cache.describe(model_cls, {"seed": seed, **kwargs})
+                cached = cache.get(content, agents)
+                if cached is None:
+                    descriptions[run_id] = content
+                    misses.append((run_id, iteration, kwargs, seed))
+                else:
+                    yield {"RunId": run_id, "iteration": iteration, "params": kwargs, "seed": seed, **cached}
+            runs = misses
+        if chunksize is None:
+            chunksize = max(1, len(runs) // (processes * 4))
+        chunks = [runs[i:i + chunksize] for i in range(0, len(runs), chunksize)]
+        for chunk in map_chunks(process_func, chunks):
+            for result in chunk:
+                if cache is not None:
+                    cache.put(descriptions[result["RunId"]], result["columns"], result["agent_columns"])
+                yield result
+
+    if processes == 1:
+        yield functools.partial(run_chunks, map)
+        return
+    with SharedInputs(state, county) as inputs, \
+            Pool(processes, initializer=attach_shared_inputs, initargs=(inputs.spec, inputs.meta)) as pool:
+        yield functools.partial(run_chunks, pool.imap_unordered)
+
+
+def batch_run(model_cls, parameters, iterations=1, number_processes=None, seed=None, store=None,
+              scenario="default", ledger=None, agents=False, aggregator=None, raw=True, cache=None,
+              chunksize=None, state="Florida", county="Miami-Dade County", display_progress=True):
+    """
+    Batch runs a model over all combinations of the parameters in a process pool that shares the model inputs.
+
+    Args:
+        model_cls: The model class to batch-run.
+        parameters (dict or list of dict): Model parameters, see make_runs.
+        iterations (int): Number of iterations for each parameter combination.
+        number_processes (int, optional): Number of processes, None uses all CPUs and 1 runs in this process.
+        seed (int, optional): Seed the run seeds are drawn from, see make_runs. A random seed is drawn and
+            recorded in the ledger if not given.
+        store (ResultStore, optional): Store the runs are written to as soon as they finish. Without a store
+            the results are returned.
+        scenario (str): Name of the scenario the runs are stored under.
+        ledger (str, optional): File recording completed runs. Runs in the ledger are skipped, so calling
+            batch_run again with the same arguments resumes an interrupted sweep. Defaults to
+            <store root>/<scenario>.ledger.jsonl when a store is given and raw is True.
+        agents (bool): Also return or store the agent reporters.
+        aggregator (OnlineStats.StepAggregator, optional): Every run is added to it as soon as it finishes.
+            With a store, its summary is written to the store at the end. When a sweep is resumed, the runs in
+            the ledger are read back from the store and added first, so the summary covers all runs.
+        raw (bool): Return or store every run. With an aggregator, False keeps only the aggregates.
+        cache (ResultCache, optional): Cache of runs, see worker_pool.
+        chunksize (int, optional): Number of runs sent to a worker at once.
+        state (str): State of the tract data placed in shared memory.
+        county (str): County of the tract data placed in shared memory.
+        display_progress (bool): Display batch run progress.
+
+    Returns:
+        list: Without a store, a dict per completed run with RunId, iteration, params, seed, the model
+        reporters as "columns" ("Step" plus one array per reporter) and the agent reporters as
+        "agent_columns". Runs skipped through the ledger are not included. None when a store is given.
+    """
+    if ledger is None and store is not None and raw:
+        ledger = os.path.join(store.root, f"{scenario}.ledger.jsonl")
+    ledger_seed, completed = read_ledger(ledger)
+    if ledger_seed is not None:
+        if seed is not None and seed != ledger_seed:
+            raise ValueError(f"Ledger {ledger} belongs to a sweep with seed {ledger_seed}, not {seed}")
+        seed = ledger_seed
+    elif seed is None:
+        seed = np.random.SeedSequence().entropy # Recorded, so the sweep can be resumed with the same seeds
+    if ledger is not None and ledger_seed is None:
+        with open(ledger, "w") as file:
+            file.write(json.dumps({"seed": seed}) + "\n")
+    all_runs = make_runs(parameters, iterations, seed)
+    runs = [run for run in all_runs if run[0] not in completed]
+    if aggregator is not None and completed:
+        # The aggregate of a resumed sweep is rebuilt from the completed runs, which are read back from the store
+        if not (raw and store is not None):
+            raise ValueError(f"Ledger {ledger} has completed runs that were not stored, so the aggregator can "
+                             f"not include them; resume with raw=True and a store, or start a new ledger")
+        stored = {meta["RunId"]: path for path, meta in store.runs(scenario)}
+        for run_id, _, kwargs, _ in all_runs:
+            if run_id in completed:
+                if run_id not in stored:
+                    raise ValueError(f"Run {run_id} is in ledger {ledger} but not in the store")
+                aggregator.update(kwargs, load_columns(stored[run_id])[0])
+
+    results = []
+    with tqdm(total=len(runs), disable=not display_progress) as pbar, \
+            worker_pool(model_cls, agents, number_processes, state, county, cache) as run_chunks:
+        for result in run_chunks(runs, chunksize):
+            if aggregator is not None:
+                aggregator.update(result["params"], result["columns"])
+            if raw and store is not None:
+                store.write(scenario, result["RunId"], result["iteration"], result["params"],
+                            result["columns"], result["agent_columns"])
+            elif raw:
+                results.append(result)
+            if ledger is not None:
+                with open(ledger, "a") as file:
+                    file.write(json.dumps({"RunId": result["RunId"], "seed": result["seed"]}) + "\n")
+            pbar.update()
+    if aggregator is not None and store is not None:
+        store.write_summary(scenario, aggregator)
+    return None if store is not None else results
+
+
+def adaptive_batch_run(model_cls, parameters, metrics, tolerance, min_iterations=10, max_iterations=500,
+                       batch_size=None, confidence=0.95, relative=False, number_processes=None, seed=None,
+                       store=None, scenario="default", cache=None, state="Florida", county="Miami-Dade County",
+                       display_progress=True):
+    """
+    Batch runs a model with a replicate count that adapts to every parameter combination. Running statistics
+    of the final step value of every metric are kept per combination, and no more replicates are started for a
+    combination once the confidence interval of the mean of every metric is narrow enough.
+
+    Replicates are started in rounds: min_iterations for every combination first, then batch_size more for
+    every combination that has not converged, until max_iterations is reached.
+
+    Args:
+        model_cls: The model class to batch-run.
+        parameters (dict or list of dict): Model parameters, see make_runs.
+        metrics (list of str): Model reporters the stopping rule is applied to.
+        tolerance (float or dict): Largest accepted half-width of the confidence interval, for all metrics
+            or per metric.
+        min_iterations (int): Replicates run for every combination before the stopping rule is checked.
+        max_iterations (int): Largest number of replicates of a combination.
+        batch_size (int, optional): Replicates added per round to a combination that has not converged.
+            Defaults to the number of processes.
+        confidence (float): Confidence level of the interval.
+        relative (bool): Compare the half-width relative to the absolute mean instead of absolute.
+        number_processes (int, optional): Number of processes, None uses all CPUs and 1 runs in this process.
+        seed (int, optional): Seed the run seeds are drawn from. Every (combination, iteration) gets its own
+            seed, so the replicates do not depend on the order of the rounds.
+        store (ResultStore, optional): Store every run is written to.
+        scenario (str): Name of the scenario the runs are stored under.
+        cache (ResultCache, optional): Cache of runs, see worker_pool.
+        state (str): State of the tract data placed in shared memory.
+        county (str): County of the tract data placed in shared memory.
+        display_progress (bool): Display batch run progress.
+
+    Returns:
+        pandas.DataFrame: One row per combination with the parameters, the number of replicates, whether the
+        stopping rule was met, and the mean and half-width of every metric.
+    """
+    combinations = [kwargs for _, _, kwargs, _ in make_runs(parameters, 1)]
+    tolerances = np.array([tolerance[metric] if isinstance(tolerance, dict) else tolerance for metric in metrics])
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    batch_size = batch_size or number_processes or os.cpu_count()
+    online = [OnlineStats(len(metrics)) for _ in combinations]
+    started = [0] * len(combinations)
+
+    def converged(point):
+        half_width = online[point].half_width(confidence)
+        if relative:
+            half_width = half_width / np.abs(online[point].mean)
+        return online[point].count >= min_iterations and bool(np.all(half_width <= tolerances))
+
+    with tqdm(disable=not display_progress) as pbar, \
+            worker_pool(model_cls, False, number_processes, state, county, cache) as run_chunks:
+        while True:
+            runs = []
+            for point, kwargs in enumerate(combinations):
+                if converged(point) or started[point] >= max_iterations:
+                    continue
+                n_new = max(min_iterations - started[point], batch_size)
+                for iteration in range(started[point], min(started[point] + n_new, max_iterations)):
+                    run_seed = int(np.random.SeedSequence([seed, point, iteration]).generate_state(1)[0])
+                    runs.append((point * max_iterations + iteration, iteration, kwargs, run_seed))
+                started[point] = min(started[point] + n_new, max_iterations)
+            if not runs:
+                break
+            pbar.total = (pbar.total or 0) + len(runs)
+            pbar.refresh()
+            for result in run_chunks(runs):
+                point = result["RunId"] // max_iterations
+                online[point].update(np.array([result["columns"][metric][-1] for metric in metrics], dtype=float))
+                if store is not None:
+                    store.write(scenario, result["RunId"], result["iteration"], result["params"],
+                                result["columns"])
+                pbar.update()
+
+    rows = []
+    for point, kwargs in enumerate(combinations):
+        row = dict(kwargs, iterations=online[point].count, converged=converged(point))
+        for i, metric in enumerate(metrics):
+            row[f"{metric}_mean"] = online[point].mean[i]
+            row[f"{metric}_half_width"] = online[point].half_width(confidence)[i]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def compare_scenarios(model_cls, base, variants, metrics, iterations=30, common_random_numbers=True,
+                      antithetic=False, stratified_bootstrap=False, confidence=0.95, number_processes=None,
+                      seed=None, store=None, cache=None, state="Florida", county="Miami-Dade County",
+                      display_progress=True):
+    """
+    Compares policy variants (e.g. other watch_shift or communication_timing values) against a base scenario
+    on the final step value of the metrics, with variance reduction designs:
+        - Common random numbers: replicate i of every scenario runs with the same seed, so the scenarios share
+          the population and the random streams, and the differences are paired.
+        - Antithetic decisions: every replicate is run twice with the same seed, the second time with
+          antithetic=True (1 - u for the action decisions), and the replicate value is the mean of the pair.
+        - Stratified bootstrap: the survey respondents are resampled with a balanced bootstrap.
+
+    Args:
+        model_cls: The model class to run.
+        base (dict): Parameters of the base scenario, single values.
+        variants (dict): Name of every variant to the parameters it changes in the base scenario.
+        metrics (list of str): Model reporters compared at the final step.
+        iterations (int): Number of replicates of every scenario.
+        common_random_numbers (bool): Pair the replicates of the scenarios by seed. Without, every scenario
+            gets independent seeds, as a reference for the variance reduction.
+        antithetic (bool): Run an antithetic pair per replicate.
+        stratified_bootstrap (bool): Use a balanced bootstrap of the survey respondents.
+        confidence (float): Confidence level of the interval of the differences.
+        number_processes (int, optional): Number of processes, None uses all CPUs and 1 runs in this process.
+        seed (int, optional): Seed the replicate seeds are drawn from.
+        store (ResultStore, optional): Store every run is written to, under the name of its scenario.
+        cache (ResultCache, optional): Cache of runs, see worker_pool. With common random numbers, runs of the
+            base scenario are shared by every comparison against it.
+        state (str): State of the tract data placed in shared memory.
+        county (str): County of the tract data placed in shared memory.
+        display_progress (bool): Display batch run progress.
+
+    Returns:
+        pandas.DataFrame: One row per variant and metric with the means of both scenarios, the mean difference
+        (variant - base), the variance of the replicate differences and the half-width of the confidence
+        interval of the mean difference. independent_variance is the variance of a replicate difference
+        had the scenarios been run independently, estimated from the variance of single runs, and
+        variance_reduction the ratio of the two.
+    """
+    scenarios = {"base": dict(base), **{name: {**base, **overrides} for name, overrides in variants.items()}}
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    draws = (False, True) if antithetic else (False,)
+
+    runs = []
+    for point, kwargs in enumerate(scenarios.values()):
+        for iteration in range(iterations):
+            # With common random numbers the seed of a replicate does not depend on the scenario
+            entropy = [seed, iteration] if common_random_numbers else [seed, point, iteration]
+            run_seed = int(np.random.SeedSequence(entropy).generate_state(1)[0])
+            for draw, flipped in enumerate(draws):
+                run_kwargs = dict(kwargs, stratified_bootstrap=stratified_bootstrap, antithetic=flipped)
+                runs.append(((point * iterations + iteration) * len(draws) + draw, iteration, run_kwargs,
+                             run_seed))
+
+    values = np.full((len(scenarios), iterations, len(draws), len(metrics)), np.nan)
+    names = list(scenarios)
+    with tqdm(total=len(runs), disable=not display_progress) as pbar, \
+            worker_pool(model_cls, False, number_processes, state, county, cache) as run_chunks:
+        for result in run_chunks(runs):
+            run, draw = divmod(result["RunId"], len(draws))
+            point, iteration = divmod(run, iterations)
+            values[point, iteration, draw] = [np.nan if result["columns"][metric][-1] is None
+                                              else result["columns"][metric][-1] for metric in metrics]
+            if store is not None:
+                store.write(names[point], result["RunId"], result["iteration"], result["params"],
+                            result["columns"])
+            pbar.update()
+
+    replicates = values.mean(axis=2) # (scenario x replicate x metric), antithetic pairs averaged
+    run_variance = np.nanvar(values.reshape(len(scenarios), -1, len(metrics)), axis=1, ddof=1)
+    t = stats.t.ppf((1 + confidence) / 2, iterations - 1)
+    rows = []
+    for point, name in enumerate(names[1:], start=1):
+        differences = replicates[point] - replicates[0]
+        for i, metric in enumerate(metrics):
+            variance = np.nanvar(differences[:, i], ddof=1)
+            count = np.count_nonzero(~np.isnan(differences[:, i]))
+            independent = (run_variance[0, i] + run_variance[point, i]) / len(draws)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                rows.append({"variant": name, "metric": metric,
+                             "base_mean": np.nanmean(replicates[0, :, i]),
+                             "variant_mean": np.nanmean(replicates[point, :, i]),
+                             "difference": np.nanmean(differences[:, i]),
+                             "difference_variance": variance,
+                             "difference_half_width": t * np.sqrt(variance / count),
+                             "independent_variance": independent,
+                             "variance_reduction": independent / variance,
+                             "replicates": count})
+    return pd.DataFrame(rows)
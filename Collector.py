@@ -0,0 +1,178 @@
+"""
+Collector.py
+
+Defines the `ArrayDataCollector`, which replaces `mesa.DataCollector` for the `EvacuationDec` model.
+All buffers are allocated when the model is created: one value per step for every model reporter and
+one (step x agent) array for every agent reporter. Collecting a step only writes into these arrays, and
+the DataFrames mesa creates are only built when they are requested.
+
+Dependencies:
+    - numpy: numerical operations
+    - pandas: export of the collected data
+"""
+
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+# Data type of the agent reporter buffers, other attributes are stored as floats of the float_dtype of the collector
+AGENT_DTYPES = {"phase": np.int8}
+
+
+class ArrayDataCollector:
+    def __init__(self, model, model_reporters=None, agent_reporters=None, float_dtype=np.float64):
+        """
+        Args:
+            model: The EvacuationDec model, used for the number of steps and agents to allocate.
+            model_reporters (dict): Reporter name to model attribute name or function of the model.
+            agent_reporters (dict): Reporter name to agent attribute name.
+            float_dtype (numpy.dtype): Data type of the agent reporter buffers. float64 keeps the exact values
+                of the agents, as mesa's DataCollector does; float32 halves the memory of the buffers, but the
+                stored values are rounded.
+        """
+        self.model_reporters = dict(model_reporters or {})
+        self.agent_reporters = dict(agent_reporters or {})
+        self.n_agents = model.population_snapshot.size
+        self.collected = 0 # Number of collected steps
+        self.steps = np.zeros(model.number_of_steps, dtype=np.int64) # Model step of every collected row
+
+        # Model reporters start as integers and become floats once a reporter returns a float or None
+        self._model_buffers = {name: np.zeros(model.number_of_steps, dtype=np.int64)
+                               for name in self.model_reporters}
+        self._agent_buffers = {name: np.zeros((model.number_of_steps, self.n_agents),
+                                              dtype=AGENT_DTYPES.get(attribute, float_dtype))
+                               for name, attribute in self.agent_reporters.items()}
+        # Marks the agents that were still in the model when the step was collected
+        self._present = np.zeros((model.number_of_steps if self.agent_reporters else 0, self.n_agents), dtype=bool)
+
+    def _grow(self):
+        """Doubles the number of steps the buffers can hold."""
+        self.steps = np.concatenate([self.steps, np.zeros_like(self.steps)])
+        for buffers in (self._model_buffers, self._agent_buffers):
+            for name, buffer in buffers.items():
+                buffers[name] = np.concatenate([buffer, np.zeros_like(buffer)])
+        if self.agent_reporters:
+            self._present = np.concatenate([self._present, np.zeros_like(self._present)])
+
+    def _model_value(self, model, reporter):
+        """Evaluates a model reporter: an attribute name, a function of the model or [function, parameters]."""
+        if isinstance(reporter, str):
+            return getattr(model, reporter, None)
+        if isinstance(reporter, list):
+            return reporter[0](*reporter[1])
+        return reporter(model)
+
+    def collect(self, model):
+        """Collect all the data for the given model object."""
+        if self.collected == len(self.steps):
+            self._grow()
+        row = self.collected
+        self.steps[row] = model.steps
+
+        for name, reporter in self.model_reporters.items():
+            value = self._model_value(model, reporter)
+            buffer = self._model_buffers[name]
+            if value is None:
+                value = np.nan
+            if buffer.dtype.kind == "i" and not (isinstance(value, (int, np.integer)) or float(value).is_integer()):
+                buffer = self._model_buffers[name] = buffer.astype(float)
+            buffer[row] = value
+
+        if self.agent_reporters:
+            if model.population is not None:
+                # Array engine: every attribute is one array write for the active agents
+                model.population.advance()
+                idx = model.population.active()
+                self._present[row, idx] = True
+                for name, attribute in self.agent_reporters.items():
+                    self._agent_buffers[name][row, idx] = getattr(model.population, attribute)[idx]
+            else:
+                agents = list(model.agents)
+                idx = np.fromiter((agent.unique_id for agent in agents), dtype=np.int64, count=len(agents)) - 1
+                self._present[row, idx] = True
+                for name, attribute in self.agent_reporters.items():
+                    values = [getattr(agent, attribute, None) for agent in agents]
+                    self._agent_buffers[name][row, idx] = [np.nan if value is None else value for value in values]
+        self.collected += 1
+
+    @property
+    def model_vars(self):
+        """Collected model reporter values per reporter, indexed by collected step like mesa's model_vars."""
+        return {name: buffer[:self.collected] for name, buffer in self._model_buffers.items()}
+
+    @property
+    def _agent_records(self):
+        """Agent records per step as (step, agent id, *values) tuples, built on request. Used by mesa's batch_run."""
+        return _AgentRecords(self)
+
+    def agent_vars(self, name):
+        """
+        Returns the collected values of an agent reporter as a (step x agent) array. Agents that had left the
+        model at a step are masked.
+
+        Args:
+            name (str): Name of the agent reporter.
+
+        Returns:
+            numpy.ma.MaskedArray: Collected values, one row per collected step and one column per agent.
+        """
+        return np.ma.MaskedArray(self._agent_buffers[name][:self.collected], mask=~self._present[:self.collected])
+
+    def model_columns(self):
+        """Returns the collected steps and model reporters as columns: "Step" plus one array per reporter."""
+        return {"Step": self.steps[:self.collected], **self.model_vars}
+
+    def agent_columns(self):
+        """
+        Returns the collected agent reporters as (step x agent) arrays, together with "present", which marks
+        the agents that were still in the model at every collected step.
+        """
+        columns = {name: buffer[:self.collected] for name, buffer in self._agent_buffers.items()}
+        if self.agent_reporters:
+            columns["present"] = self._present[:self.collected]
+        return columns
+
+    def get_model_vars_dataframe(self):
+        """
+        Create a pandas DataFrame from the model variables.
+
+        The DataFrame has one column for each model variable, and the index is (implicitly) the model tick.
+        """
+        if not self.model_reporters:
+            raise UserWarning(
+                "No model reporters have been defined in the DataCollector, returning empty DataFrame.")
+        return pd.DataFrame(self.model_vars)
+
+    def get_agent_vars_dataframe(self):
+        """
+        Create a pandas DataFrame from the agent variables.
+
+        The DataFrame has one column for each variable and is indexed by step and agent id, like the
+        DataFrame of mesa's DataCollector. Only agents that were in the model at a step are included.
+        """
+        if not self.agent_reporters:
+            raise UserWarning(
+                "No agent reporters have been defined in the DataCollector, returning empty DataFrame.")
+        rows, idx = np.nonzero(self._present[:self.collected])
+        index = pd.MultiIndex.from_arrays([self.steps[rows], idx + 1], names=["Step", "AgentID"])
+        return pd.DataFrame({name: buffer[rows, idx] for name, buffer in self._agent_buffers.items()}, index=index)
+
+
+class _AgentRecords(Mapping):
+    """Read only view on the agent buffers of an ArrayDataCollector in the layout of mesa's _agent_records."""
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.rows = {step: row for row, step in enumerate(collector.steps[:collector.collected].tolist())}
+
+    def __getitem__(self, step):
+        row = self.rows[step]
+        idx = np.flatnonzero(self.collector._present[row])
+        columns = [buffer[row, idx].tolist() for buffer in self.collector._agent_buffers.values()]
+        return [(step, agent + 1, *values) for agent, *values in zip(idx.tolist(), *columns)]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
@@ -3,9 +3,8 @@
 This script runs a batch of simulations for an evacuation decision model using the Mesa framework,
 performs convergence analysis on key agent decision metrics, and visualizes the results.
 """
-from mesa import batch_run
-import pandas as pd
 from Model import EvacuationDec
+from ResultStore import ResultStore, store_batch_run
 import matplotlib.pyplot as plt
 
 if __name__ == '__main__':
@@ -13,21 +12,20 @@ if __name__ == '__main__':
     params = {"init_individuals":[1000],         # Initial agent population
               "outcome_collection":"convergence" # Specify the outcome collection mode
               }
-    # Run batch simulations using mesa's batch_run
-    result_batch = batch_run(
+    # Run batch simulations, every run is written to the result store as soon as it finishes
+    store = ResultStore("archives/results")
+    store_batch_run(
         EvacuationDec,
+        store,
+        "convergence",
         parameters=params,
         iterations=500,
-        max_steps=88,
         number_processes= None,
-        data_collection_period=1,
         display_progress=True,
     )
-    # Transform the batch run results into a DataFrame
-    df = pd.DataFrame(result_batch)
-    # Filter to only the final step of each run
-    df = df[df["Step"] == df["Step"].max()]
-    df = df.reset_index()
+    # Load only the final step of each run
+    df = store.read(scenario="convergence", step="last")
+    df = df.sort_values("RunId").reset_index(drop=True)
 
     # List of metrics to plot
     metrics = ['average_evac_time', 'hotel_choice', 'friends_choice', 'stay_choice']
@@ -39,7 +37,7 @@ if __name__ == '__main__':
         std = df[f'{metric}_running_mean'].std()
         df[f'{metric}_standardized'] = (df[f'{metric}_running_mean'] - mean) / std
     df = df.reset_index()
-    df_correct =df[['average_evac_time', 'hotel_choice', 'friends_choice', 'stay_choice', "iteration","AgentID"]].groupby("iteration").mean()
+    df_correct = df.groupby("iteration").mean(numeric_only=True)
 
     metrics = ['average_evac_time', 'hotel_choice', 'friends_choice', 'stay_choice']
 
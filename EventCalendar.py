@@ -0,0 +1,108 @@
+"""
+EventCalendar.py
+
+Defines the `EventCalendar`, the precomputed timeline of everything that changes the state of an agent that is
+not communicating: the rain cue (every step), the wind cue and storm surge state (every 3 steps), the storm surge
+watches and warnings that raise social perception, the media exposures (a respondent hears medium j at the steps
+that are a multiple of its usage frequency) and the government watch and warning.
+
+All of these only depend on the step, the tract and the survey respondent, so the calendar stores them per
+tract and per respondent for every step. Used by the array engine with time_advance="event": over a stretch of
+steps in which no agent can cross its RI_thresh or RA_thresh and nobody is in phase 2, agents neither
+communicate nor draw decisions, so their state at the end of the stretch follows from the calendar alone and
+the stretch does not have to be stepped.
+
+The values are computed with the same operations as a step of `Population`, in the same order, so an
+advanced population is equal to a stepped one bit for bit.
+
+Dependencies:
+    - numpy: numerical operations
+"""
+
+import numpy as np
+
+# Margin between the upper bound of risk perception over a stretch and the thresholds, covers rounding in the
+# bound, which adds the terms in another order than a step
+BOUND_MARGIN = 1e-9
+
+
+class EventCalendar:
+    def __init__(self, model, media_trust, media_freq):
+        """
+        Args:
+            model: The EvacuationDec model, for its cues, storm surge and communication parameters.
+            media_trust (numpy.ndarray): Weighted media trust of every respondent of the survey media table.
+            media_freq (numpy.ndarray): Media usage frequency of every respondent of the survey media table.
+        """
+        self.number_of_steps = n_steps = model.number_of_steps
+        self.warning_steps = sorted({model.trop_warning_step, model.evac_warning_step})
+        steps = np.arange(n_steps + 1)
+
+        # Cues of every tract at the end of every step, column 0 holds the starting values
+        self.rain = model.rain[:, np.maximum(steps - 1, 0)]
+        cue_step = np.where(steps >= 3, steps // 3, 0) # Last multiple of 3, the wind and surge update step
+        self.wind = model.wind[:, np.maximum(cue_step - 1, 0)]
+        self.storm_surge = model.storm_surge[:, np.where(cue_step > 0, cue_step + 1, 0)]
+
+        # Tracts whose storm surge state rises from none to watch/warning or watch to warning at a step
+        old_value, new_value = self.storm_surge[:, :-1], self.storm_surge[:, 1:]
+        raised = (((old_value == 0) & ((new_value == 0.5) | (new_value == 1)))
+                  | ((old_value == 0.5) & (new_value == 1)))
+        self.raised = np.zeros_like(self.storm_surge, dtype=bool)
+        self.raised[:, 1:] = raised & (steps[1:] % 3 == 0)
+        self.raise_steps = np.flatnonzero(self.raised.any(axis=0)).tolist()
+        # Social perception gained from storm surge raises up to every step, only used for the bounds
+        self.surge_risk = np.cumsum(self.raised, axis=1) * model.comm_watch_value_risk
+        self.env_cue = self.wind + self.rain
+
+        # Media cue of every respondent at the end of every step. The increments are non-negative, so clipping
+        # the running sum once equals clipping after every step
+        increments = np.zeros((len(media_trust), n_steps + 1))
+        for step in range(1, n_steps + 1):
+            increments[:, step] = (media_trust * (step % media_freq == 0)).sum(axis=1) / 5
+        self.media = np.minimum(np.cumsum(increments, axis=1), 1)
+
+    def next_warning(self, step):
+        """First step at or after step at which the government issues a watch or warning, or the last step."""
+        return next((warning for warning in self.warning_steps if warning >= step), self.number_of_steps)
+
+    def quiet_until(self, step, last, tract, media_rows, env_weight, cue_perception, social_perception,
+                    threshold, media_weight):
+        """
+        Finds the longest stretch of steps from step on in which none of the given agents can reach its
+        threshold. Risk perception at step t is the cue perception of step t - 1 plus social perception, so it is
+        bounded over the stretch by the highest environmental cue of the tract, the media cue at the end of the
+        stretch (which only grows, media trust is not negative) and all storm surge raises before the end.
+
+        Args:
+            step (int): First step of the stretch; the agents hold their state at the end of step - 1.
+            last (int): Last step the stretch may reach.
+            tract, media_rows, env_weight, cue_perception, social_perception (numpy.ndarray): Of every agent.
+            threshold (numpy.ndarray): RI_thresh of agents in phase 0 and RA_thresh of agents in phase 1.
+            media_weight (float): media_weight_perc of the model.
+
+        Returns:
+            int: Last step of the stretch, step - 1 if step itself can have a transition.
+        """
+        if last < step:
+            return step - 1
+        # Highest environmental cue of every tract from the end of step to the end of every later step
+        env_max = np.maximum.accumulate(self.env_cue[:, step:last], axis=1)
+        limit = threshold - BOUND_MARGIN - social_perception + self.surge_risk[tract, step - 1]
+
+        def quiet(end):
+            bound = cue_perception
+            if end > step:
+                bound = np.maximum(bound, env_weight * env_max[tract, end - 1 - step]
+                                   + media_weight * self.media[media_rows, end - 1])
+            return bool((bound + self.surge_risk[tract, end - 1] < limit).all())
+
+        # The bound grows with the end of the stretch, so the longest stretch is found by bisection
+        low, high = step - 1, last
+        while low < high:
+            middle = (low + high + 1) // 2
+            if quiet(middle):
+                low = middle
+            else:
+                high = middle - 1
+        return low
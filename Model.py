@@ -1,13 +1,14 @@
 """Module for implementing an evacuation decision model."""
 import warnings
-import pickle
-import mesa
 import networkx as nx
 import numpy as np
 from mesa import Model
 from mesa.space import NetworkGrid
-from scipy.spatial import KDTree
 from Agent import Individual
+from Collector import ArrayDataCollector
+from Population import PRUNE_FRACTION, Population, PopulationSnapshot
+from Scheduler import PhaseScheduler
+from TopologyCache import TopologyCache
 from helper_functions import *
 from run_config import *
 
@@ -17,6 +18,8 @@ warnings.filterwarnings("ignore")
 class EvacuationDec(Model):
     """An agent-based model for simulating evacuation decisions."""
 
+    rewiring_probability = 0.7 # Rewiring probability of the Watts Strogatz graph
+
     def __init__(
             self,
              state = "Florida",             # Lost functionality, do not change
@@ -53,16 +56,41 @@ class EvacuationDec(Model):
              RI_base = 0.2,                 # The threshold value to move out the risk identification
              threshold_strength_RA = 0.4,   # Influence of the survey RA value on RA_base
              env_strength = 0.18 ,          # Influence of the environmental cues on risk perception
-             outcome_collection="phase_1"): # Determines what data the collector will collect
+             outcome_collection="phase_1",  # Determines what data the collector will collect
+             engine="agent",                # "agent" steps Individual objects, "array" steps a batched Population
+             household_placement=False,     # Places agents at a sampled household inside their tract polygon
+             network="array",               # "array" builds the acquaintance graph as CSR arrays, "networkx" as
+                                            # a networkx graph on which the agents are placed with a NetworkGrid
+             stratified_bootstrap=False,    # Resamples every survey respondent equally often (balanced bootstrap)
+             antithetic=False,              # Uses 1 - u for the action decisions, the antithetic pair of a seed
+             snapshot=None,                 # PopulationSnapshot to reuse instead of building a new population
+             topology_cache=None,           # Directory of a TopologyCache the population is loaded from or stored in
+             time_advance="step",           # "event" skips quiet stretches of the array engine, see EventCalendar
+             agent_data_dtype="float64",    # "float32" halves the memory of the agent reporters, rounding them
+             run=True):                     # Runs the model directly after creation, as batch_run expects
 
         super().__init__(seed=seed)
-
-        # Creates a Watts Strogatz Graph simulating a small world network
-        self.G = nx.watts_strogatz_graph(init_individuals, node_connectivity, 0.7, seed=None, create_using=None)
-        self.grid = NetworkGrid(self.G)
+        # Independent random streams for the graph, placement, neighbours, bootstrap, decisions and schedule,
+        # all spawned from the seed, so a seeded run is exactly reproducible
+        self.streams = spawn_streams(seed)
+        # The schedule of the agent engine shuffles with mesa's random, which is reseeded from its own stream
+        self.reset_randomizer(int(self.streams["schedule"].integers(2 ** 63)))
+
+        if engine not in ("agent", "array"):
+            raise ValueError(f"Unknown engine '{engine}', use 'agent' or 'array'")
+        self.engine = engine
+        self.antithetic = antithetic
+        if network not in ("array", "networkx"):
+            raise ValueError(f"Unknown network '{network}', use 'array' or 'networkx'")
+        self.network = network
+        if time_advance not in ("step", "event"):
+            raise ValueError(f"Unknown time_advance '{time_advance}', use 'step' or 'event'")
+        if time_advance == "event" and engine != "array":
+            raise ValueError("time_advance='event' requires engine='array'")
+        self.time_advance = time_advance
 
         # Loads the logistic model used to calculate probabilities for destination options
-        self.logistic_model = pickle.load(open('regression models/reg_results_FINAL/finalized_model.sav', 'rb'))
+        self.logistic_model = load_logistic_model()
         self.media_weight_trust = media_weight_trust
         self.media_weight_perc = media_weight_perc
 
@@ -81,7 +109,10 @@ class EvacuationDec(Model):
         self.ceiling = ceiling
         self.number_of_steps = number_of_steps
         self.phase_change_factor = phase_change_factor
+        self.node_connectivity = node_connectivity
         # Determines the timings for the watch and warning for both the hurricane as the storm surge
+        self.watch_shift = watch_shift
+        self.communication_timing = communication_timing
         self.trop_warning_step = evac_watch_step - watch_shift - communication_timing
         self.evac_warning_step = evac_warning_step - communication_timing
         self.action_comm_value = action_comm_value
@@ -107,59 +138,196 @@ class EvacuationDec(Model):
         self.stay_choice = 0
 
 
-        # Retrieves the living areas, rain cues, wind cues and areas affected by the storm surge
-        init_data = agent_init_data([state], [county])
-        pos_probs = init_data["geometry"].centroid
-        pos_idx = list(pos_probs)
+        # Builds the graph, living areas, neighbours and survey sample, unless an existing population is reused
+        # or the population of this seed was built before and is found in the topology cache
+        if snapshot is None and topology_cache is not None:
+            snapshot = TopologyCache(topology_cache).population(self, seed, state, county, init_individuals,
+                                                                node_connectivity, n_neighbors, household_placement,
+                                                                stratified_bootstrap, network)
+        elif snapshot is None:
+            snapshot = self.build_population(state, county, init_individuals, node_connectivity, n_neighbors,
+                                             household_placement, stratified_bootstrap=stratified_bootstrap,
+                                             network=network)
+        self.population_snapshot = snapshot
+        self.G = snapshot.G
+        self.acquaintances = snapshot.acquaintances
+        self.neighbours = snapshot.neighbours
+        self.tracts = snapshot.tracts
+        self.n_neighbors = snapshot.n_neighbors
+        self.household_placement = snapshot.household_placement
+        self.agent_xy = snapshot.agent_xy
+        self.neighbour_table = snapshot.neighbour_table
+        self.survey_rows = snapshot.survey_rows
+        self.media_rows = snapshot.media_rows
+
+        # Cues of every tract as (tract x timestep) arrays, agents only store the index of their tract
+        self.wind = self.tracts["wind"]
+        self.rain = self.tracts["rain"]
+        # Timing for storm surge watch and warning only depends on the tract, so it is shifted once per tract
+        self.storm_surge = np.array([shift_watch_warning(surge.tolist(),
+                                                         timing=int(communication_timing/3),
+                                                         gap=int(watch_shift/3)) for surge in self.tracts["storm_surge"]])
+
+        # Survey tables are loaded once per process, agents refer to their respondent by row index
+        self.survey = survey_data()
+        # Probabilities of the protective actions for the whole population, gathered from the survey respondents
+        self.action_probabilities = survey_action_probabilities()[self.survey_rows]
+
+        if self.engine == "array":
+            self.population = Population(self, self.survey_rows, self.media_rows, snapshot.tract,
+                                         self.acquaintances, snapshot.neighbours, time_advance=time_advance)
+        else:
+            self.population = None
+            self.create_agents(snapshot.tract)
+
+        # Defines datacollector, which preallocates the buffers for all steps and agents
+        self.datacollector = ArrayDataCollector(
+            self,
+            agent_reporters=data_collection_attributes(outcome_collection)[0],
+            model_reporters=data_collection_attributes(outcome_collection)[1],
+            float_dtype=np.dtype(agent_data_dtype))
+
+        # Required to make the model stop at the correct time
+        if run:
+            self.run_model()
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **kwargs):
+        """
+        Creates a model on a population built earlier, for example to run it under different policy parameters
+        (watch_shift, communication_timing, comm_*_value_*, media_weight_*, ...). The graph, living areas,
+        neighbours and survey sample are taken from the snapshot, so the arguments that define them
+        (state, county, init_individuals, node_connectivity, n_neighbors, household_placement,
+        stratified_bootstrap, network) are ignored.
 
-        # Splits the values in init_data to separate variables
-        wind_list = init_data["WindCat"].apply(parse_np_float_string)
-        rain_list = init_data["RainCat"].apply(parse_np_float_string)
-        surge_list = init_data["storm_Surge"].apply(parse_np_float_string)
+        Args:
+            snapshot (PopulationSnapshot): Population returned by `EvacuationDec.snapshot`.
+            **kwargs: Any other argument of EvacuationDec.
+
+        Returns:
+            EvacuationDec: The new model, which has already run unless run=False is given.
+        """
+        return cls(snapshot=snapshot, **kwargs)
+
+    def snapshot(self):
+        """
+        Returns the population this model was built on. The snapshot only holds read only arrays, which every
+        model created from it shares; agent state is allocated per model, so runs never change the snapshot.
+        """
+        return self.population_snapshot
 
-        # Required for KDE-tree, which is needed for neighbor calculation
-        self.pos_dict = {}
+    def build_population(self, state, county, init_individuals, node_connectivity, n_neighbors,
+                         household_placement, streams=None, stratified_bootstrap=False, network="array"):
+        """
+        Builds everything about the population that does not depend on the behavioural or policy parameters: the
+        acquaintance graph, the living areas, households and closest neighbours, and the bootstrapped survey rows.
+
+        Args:
+            streams (dict, optional): Random streams to build with, see spawn_streams. Defaults to the streams of
+                the model.
+            stratified_bootstrap (bool): Resamples the survey respondents with a balanced bootstrap, see
+                population_bootstrapper.
+            network (str): "array" builds the acquaintance graph with small_world_graph as a CSR adjacency
+                matrix, "networkx" as a networkx graph.
+
+        Returns:
+            PopulationSnapshot: The built population.
+        """
+        streams = streams if streams is not None else self.streams
+        # Creates a Watts Strogatz Graph simulating a small world network
+        if network == "networkx":
+            G = nx.watts_strogatz_graph(init_individuals, node_connectivity, self.rewiring_probability,
+                                        seed=int(streams["graph"].integers(2 ** 32)), create_using=None)
+        else:
+            G = small_world_graph(init_individuals, node_connectivity, self.rewiring_probability, streams["graph"])
+
+        # Retrieves the living areas, rain cues, wind cues and areas affected by the storm surge
+        # Loaded from the columnar cache of the tract data, which is only rebuilt when data.gpkg changes
+        tracts = tract_data([state], [county])
+        tract_xy = np.column_stack([tracts["x"], tracts["y"]]) # Tract centroids
+
+        # Determines living location of all agents using the population densities
+        tract = streams["placement"].choice(len(tract_xy), size=init_individuals, p=tracts["PopDense"])
+        # Location of every agent, the centroid of its tract or a sampled household inside it
+        if household_placement:
+            agent_xy = household_positions(tract, tracts, streams["placement"])
+        else:
+            agent_xy = tract_xy[tract]
+        # Finds the closest neighbours through the spatial index over the tracts
+        tract_tree, neighbours = tract_neighbour_table(tract, tract_xy, n_neighbors, streams["neighbours"],
+                                                       agent_xy if household_placement else None)
 
         # Loads the bootstrapped data from the survey
-        factor_data, weight_data, media_weight = population_bootstrapper(len(self.G.nodes))
+        survey_rows, media_rows = population_bootstrapper(init_individuals, streams["bootstrap"],
+                                                          stratified=stratified_bootstrap)
+
+        return PopulationSnapshot(
+            state=state, county=county, n_neighbors=n_neighbors, household_placement=household_placement,
+            G=G, tracts=tracts, tract=tract, agent_xy=agent_xy, tract_tree=tract_tree, neighbour_table=neighbours,
+            survey_rows=survey_rows, media_rows=media_rows)
+
+    def decision_draws(self, size=None, stream=None):
+        """
+        Draws the uniform numbers the protective action decisions are compared against. An antithetic model
+        returns 1 - u for every u of the decision stream, so a run and its antithetic pair with the same seed
+        make negatively correlated decisions.
+
+        Args:
+            size (int, optional): Number of draws, a single float if None.
+            stream (numpy.random.Generator, optional): Decision stream to draw from, the one of the model if
+                not given. Stacked replicates draw from the stream of their own seed.
+        """
+        draws = (stream if stream is not None else self.streams["decisions"]).random(size)
+        return 1 - draws if self.antithetic else draws
+
+    def base_immediacy(self, n_steps):
+        """Base value of immediacy at a step, equal for all agents; it grows towards ceiling over the run."""
+        return self.ceiling * ((n_steps + 1) * (1 / self.number_of_steps)) / (
+                    1 + self.grow_factor * (1 - (n_steps + 1) * (1 / self.number_of_steps)))
 
+    def create_agents(self, tract):
+        """
+        Creates an Individual for every network node. Agents find their acquaintances and closest neighbours
+        through the model, in the acquaintance operator and neighbour table, and their media usage in the
+        media tables below. Agents are only placed on a NetworkGrid when the graph is a networkx graph.
+        """
+        self.grid = NetworkGrid(self.G) if isinstance(self.G, nx.Graph) else None
+        # Media trust and usage frequency of every respondent of the survey media table
+        media_values = self.survey["media"]
+        self.media_trust = self.media_weight_trust * media_values[:, :-5]
+        self.media_freq = media_values[:, :5]
         # Loops over network nodes and creates an agent for every node
-        for node_id in range(len(self.G.nodes)):
-            # Determines living location of agent using the population densities
-            population_idx = np.random.choice(len(init_data), p=init_data["PopDense"])
+        for node_id in range(self.population_snapshot.size):
             # Assigns the correct data for living area and bootstrapped survey data
             agent_attributes = {
-                "factor_values": factor_data.iloc[[node_id]], # Factor values for logistic model
-                "weight_values": weight_data.iloc[node_id],   # Weights RA threshold and environmental cues perception
-                "media_values": media_weight.iloc[[node_id]], # Trust and frequency values for media cue
-                'wind': wind_list[population_idx], # Wind cue values
-                'rain': rain_list[population_idx], # Rain cue values
-                # Timing for storm surge watch and warning
-                "storm_surge": shift_watch_warning(surge_list[population_idx],
-                                                   timing=int(communication_timing/3),
-                                                   gap=int(watch_shift/3)),
+                "tract": tract[node_id],                      # Tract for wind, rain and storm surge cues
+                "survey_row": self.survey_rows[node_id],      # Weights RA threshold and environmental cues perception
+                "media_row": self.media_rows[node_id],        # Trust and frequency values for media cue
             }
             # Initiate agent
             agent = Individual(self, **agent_attributes)
-            # Add agent to dictionary for KDE-tree
-            self.pos_dict[agent] = pos_idx[population_idx]
             # Add agent to model schedule
-            self.grid.place_agent(agent, node_id)
+            if self.grid is not None:
+                self.grid.place_agent(agent, node_id)
 
-        # Defines KDE-Tree
-        coords = np.array([(pt.x, pt.y) for pt in self.pos_dict.values()])
-        self.tree = KDTree(coords)
-        # Defines closest neighbours
-        for agent in self.agents:
-            agent.neigh_individuals = closest_neighbours(agent.model, agent.unique_id, n_neighbors)
-
-        # Defines datacollector
-        self.datacollector = mesa.DataCollector(
-            agent_reporters=data_collection_attributes(outcome_collection)[0],
-            model_reporters=data_collection_attributes(outcome_collection)[1])
+        # Agent of every node, removed agents included, so acquaintances and neighbours can be looked up by index
+        self.individuals = list(self.agents)
+        self._pruned_size = len(self.individuals) # Number of agents when the operators were last pruned
+        self.scheduler = PhaseScheduler(self, self.individuals)
 
-        # Required to make the model stop at the correct time
-        self.run_model()
+    def prune_departed(self):
+        """
+        Agent engine counterpart of `Population.compact`: the agents that implemented a protective action are
+        removed from the model, and once their number has grown enough they are also pruned from the
+        acquaintance and neighbour operators the remaining agents look up their contacts in.
+        """
+        if len(self.agents) > PRUNE_FRACTION * self._pruned_size:
+            return
+        keep = np.zeros(len(self.individuals), dtype=bool)
+        keep[np.fromiter((agent.unique_id for agent in self.agents), dtype=np.int64, count=len(self.agents)) - 1] = True
+        self.acquaintances = prune_operator(self.acquaintances, keep)
+        self.neighbours = prune_operator(self.neighbours, keep)
+        self._pruned_size = len(self.agents)
 
     def government_warning_communication(self, comm_value_risk: float, comm_value_immediacy: float) -> None:
         """Update agents' perceptions based on government communications.
@@ -168,19 +336,26 @@ class EvacuationDec(Model):
             comm_value_risk: Risk communication value
             comm_value_immediacy: Propensity communication value
         """
+        if self.engine == "array":
+            self.population.government_warning_communication(comm_value_risk, comm_value_immediacy)
+            return
         for agent in self.agents:
             agent.social_perception += comm_value_risk
             agent.immediacy_cum += comm_value_immediacy
 
     def step(self):
 
-        # Counts how many agents are in each phase
-        self.phase_0 =self.agents.get("phase").count(0)
-        self.phase_1 =self.agents.get("phase").count(1)
-        self.phase_2 =self.agents.get("phase").count(2)
-
-        # Randomizes order schedule and cycle over agent step function
-        self.agents.shuffle_do("step")
+        if self.engine == "array":
+            # Counts how many active agents are in each phase and updates all phases as a batch
+            self.phase_0, self.phase_1, self.phase_2 = (int(count) for count in self.population.phase_counts())
+            self.population.step()
+        else:
+            # The scheduler keeps the agents by phase, so the counts are known without counting
+            self.phase_0, self.phase_1, self.phase_2 = self.scheduler.counts()
+
+            # Steps the agents in random order
+            self.scheduler.step()
+            self.prune_departed()
         # Caluclates final metrics at the last model step and stops model
         if self.steps == self.number_of_steps:
 
@@ -0,0 +1,177 @@
+"""
+OnlineStats.py
+
+Running statistics that are updated one replicate at a time, so results of a sweep can be summarised
+without keeping every run in memory.
+
+Dependencies:
+    - numpy: numerical operations
+    - pandas: summary tables
+    - scipy: quantiles of the t distribution
+"""
+
+import json
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+class OnlineStats:
+    """
+    Running mean and variance (Welford's algorithm) of values of a fixed shape, e.g. one value per metric.
+    """
+
+    def __init__(self, shape=()):
+        """
+        Args:
+            shape (tuple): Shape of the values added with update.
+        """
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self._m2 = np.zeros(shape) # Sum of squared differences from the mean
+
+    def update(self, values):
+        """Adds the values of one replicate."""
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (values - self.mean)
+
+    def merge(self, other):
+        """Adds the replicates summarised by another OnlineStats of the same shape."""
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self._m2 = self._m2 + other._m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+
+    @property
+    def variance(self):
+        """Sample variance, NaN before two replicates are added."""
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        """Sample standard deviation."""
+        return np.sqrt(self.variance)
+
+    def half_width(self, confidence=0.95):
+        """
+        Half-width of the confidence interval of the mean, based on the t distribution.
+
+        Args:
+            confidence (float): Confidence level of the interval.
+
+        Returns:
+            numpy.ndarray: Half-width per value, NaN before two replicates are added.
+        """
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return stats.t.ppf((1 + confidence) / 2, self.count - 1) * self.std / np.sqrt(self.count)
+
+
+class Reservoir:
+    """
+    Uniform sample of at most `size` replicates (reservoir sampling), used as a quantile sketch. Quantiles are
+    exact while fewer than `size` replicates are added and estimated from the sample afterwards.
+    """
+
+    def __init__(self, shape, size=256, rng=None):
+        """
+        Args:
+            shape (tuple): Shape of the values of one replicate.
+            size (int): Number of replicates kept.
+            rng (numpy.random.Generator, optional): Generator deciding which replicates are kept.
+        """
+        self.count = 0
+        self.samples = np.zeros((size, *shape))
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def update(self, values):
+        """Adds the values of one replicate."""
+        if self.count < len(self.samples):
+            self.samples[self.count] = values
+        else:
+            slot = self.rng.integers(self.count + 1)
+            if slot < len(self.samples):
+                self.samples[slot] = values
+        self.count += 1
+
+    def quantiles(self, q):
+        """
+        Args:
+            q (sequence of float): Quantiles to estimate.
+
+        Returns:
+            numpy.ndarray: Array (quantile x shape of the values).
+        """
+        return np.nanquantile(self.samples[:min(self.count, len(self.samples))], q, axis=0)
+
+
+class StepAggregator:
+    """
+    Aggregates the per step model reporters of replicates as they finish: mean, standard deviation and
+    quantiles per parameter combination and step. Only the aggregates are kept, not the trajectories.
+    """
+
+    def __init__(self, metrics, quantiles=(0.05, 0.5, 0.95), reservoir_size=256, seed=None):
+        """
+        Args:
+            metrics (list of str): Model reporters to aggregate.
+            quantiles (sequence of float): Quantiles reported per step.
+            reservoir_size (int): Replicates kept per combination for the quantiles.
+            seed (int, optional): Seed of the reservoir sampling.
+        """
+        self.metrics = list(metrics)
+        self.quantiles = tuple(quantiles)
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng(seed)
+        self.points = {} # Parameter key to (parameters, steps, OnlineStats, Reservoir)
+
+    def update(self, params, columns):
+        """
+        Adds one replicate.
+
+        Args:
+            params (dict): Model parameters of the replicate.
+            columns (dict): Model level output, "Step" plus one array per reporter.
+        """
+        values = np.stack([np.asarray(columns[metric], dtype=float) for metric in self.metrics], axis=1)
+        key = json.dumps(params, sort_keys=True, default=str)
+        if key not in self.points:
+            self.points[key] = (dict(params), np.asarray(columns["Step"]).copy(), OnlineStats(values.shape),
+                                Reservoir(values.shape, self.reservoir_size, self.rng))
+        _, steps, online, reservoir = self.points[key]
+        if len(steps) != len(values):
+            raise ValueError(f"Replicate has {len(values)} steps, earlier replicates of {params} have {len(steps)}")
+        online.update(values)
+        reservoir.update(values)
+
+    def point_columns(self):
+        """
+        Yields:
+            tuple: Parameters and summary columns of every combination: "Step", "count" and per metric
+            "<metric>_mean", "<metric>_std" and "<metric>_q<percentage>".
+        """
+        for params, steps, online, reservoir in self.points.values():
+            columns = {"Step": steps, "count": np.full(len(steps), online.count)}
+            std = online.std
+            quantiles = reservoir.quantiles(self.quantiles)
+            for i, metric in enumerate(self.metrics):
+                columns[f"{metric}_mean"] = online.mean[:, i]
+                columns[f"{metric}_std"] = std[:, i]
+                for q, values in zip(self.quantiles, quantiles):
+                    columns[f"{metric}_q{round(q * 100):02d}"] = values[:, i]
+            yield params, columns
+
+    def summary(self):
+        """
+        Returns:
+            pandas.DataFrame: One row per combination and step with the parameters and the summary columns.
+        """
+        frames = [pd.DataFrame({**params, **columns}) for params, columns in self.point_columns()]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
@@ -0,0 +1,420 @@
+"""
+Population.py
+
+Defines the `Population` class, an array-backed counterpart of the `Individual` agent in Agent.py.
+Instead of one Python object per agent, the state of the whole population is stored in contiguous NumPy
+arrays (struct-of-arrays) and every phase of the decision process is evaluated for all agents in that phase
+at once. Used by `EvacuationDec` when it is created with engine="array".
+
+The update rules are the same as in `Individual`. The only difference is that the agents of one step are
+updated as a batch instead of in a shuffled order, so influence sent to an acquaintance always becomes
+visible at the start of its next step.
+
+Agents that implemented a protective action leave the population. The indices of the remaining (active) agents
+are kept explicitly and compacted after every step, so the cost of a step scales with the agents still deciding.
+Communication only touches the receiving agents, and departed agents are pruned from the communication
+operators once the active set has shrunk enough to make rebuilding them worthwhile.
+
+With time_advance="event" the population is not stepped over quiet stretches: steps without agents in phase 2
+at which no agent can reach its threshold, found with the `EventCalendar`. Agents do not communicate or decide
+during such a stretch, so their state is only brought up to date (from the calendar) when it is read, at a
+government warning and at the first step after the stretch.
+
+Dependencies:
+    - numpy: numerical operations
+    - EventCalendar: the cues and media exposures of every step, for the event-driven time advance
+    - helper_functions: builders of the communication operators
+"""
+
+import numpy as np
+from EventCalendar import EventCalendar
+from helper_functions import acquaintance_operator, communication_operator, prune_operator
+
+# Order of the protective actions, equal to the class order of the logistic model
+ACTIONS = ("evac_friends", "evac_hotel", "evac_shelter", "stay")
+
+# Departed agents are pruned from the communication operators when the active set has shrunk to this fraction
+# of its size at the previous pruning
+PRUNE_FRACTION = 0.5
+
+
+class Population:
+    def __init__(self, model, survey_rows, media_rows, tract, acquaintances, neighbours, replicate=None,
+                 n_replicates=1, time_advance="step", decision_streams=None):
+        """
+        Args:
+            model: The EvacuationDec model the population belongs to.
+            survey_rows (numpy.ndarray): Row of every agent in the survey predictor and weight tables.
+            media_rows (numpy.ndarray): Row of every agent in the survey media table.
+            tract (numpy.ndarray): Tract index of every agent, used to gather the cues from the model arrays.
+            acquaintances (scipy.sparse.csr_matrix): Row i holds the acquaintances agent i communicates with.
+            neighbours (scipy.sparse.csr_matrix): Row i holds the physical neighbours that see agent i.
+            replicate (numpy.ndarray, optional): Replicate of every agent when several independent replicates
+                are stacked into one population, see Replicates.py. The model counters are then arrays with
+                one value per replicate.
+            n_replicates (int): Number of stacked replicates.
+            time_advance (str): "step" steps the population at every step, "event" skips quiet stretches,
+                see the module docstring. Results are equal.
+            decision_streams (list of numpy.random.Generator, optional): Decision stream of every stacked
+                replicate. Defaults to the decision stream of the model.
+        """
+        self.model = model
+        self.size = len(tract)
+        self.unique_id = np.arange(1, self.size + 1) # Same ids as the agents of the agent engine
+        self.replicate = replicate if replicate is not None else np.zeros(self.size, dtype=np.int64)
+        self.n_replicates = n_replicates
+        self.decision_streams = decision_streams
+
+        media_values = model.survey["media"][media_rows] # Survey data for media trust and usage frequency
+        self.media_trust = model.media_weight_trust * media_values[:, :-5]
+        self.media_freq = media_values[:, :5]
+        self.media_rows = media_rows
+
+        self.acquaintances = acquaintances # Acquaintance operator (sender x receiver)
+        self.neighbours = neighbours # Neighbour operator (sender x receiver)
+        self.active_idx = np.arange(self.size) # Agents that have not implemented a protective action yet
+        self._pruned_size = self.size # Size of the active set when the operators were last pruned
+
+        self.tract = tract # Tract index used to look up the cues
+
+        self.rain_cue = model.rain[tract, model.steps]
+        self.wind_cue = model.wind[tract, model.steps]
+        self.storm_surge_state = model.storm_surge[tract, model.steps]
+
+        # Starting values for attributes
+        self.risk_perception = np.zeros(self.size)
+        self.attitudes = np.zeros((self.size, len(ACTIONS)))
+        self.evac_friends, self.evac_hotel, self.evac_shelter, self.stay = self.attitudes.T # Views on attitudes
+        self.preferred_evac = np.full(self.size, -1, dtype=np.int8) # Index into ACTIONS
+        self.phase = np.zeros(self.size, dtype=np.int8)
+        self.immediacy_cum = np.zeros(self.size)
+        self.immediacy_base = 0
+        self.immediacy = np.full(self.size, np.nan) # Only known once an agent reaches phase 2
+        self.media_cue = np.zeros(self.size)
+        self.cue_perception = np.zeros(self.size)
+        self.social_perception = np.zeros(self.size)
+
+        self.RI_thresh = np.full(self.size, model.RI_base) # Threshold for risk identification phase
+
+        # Calculates the threshold for the risk assessment phase
+        weight_values = model.survey["weights"][survey_rows]
+        self.RA_thresh = model.RA_base + weight_values[:, 0] * model.threshold_strength_RA
+        self.env_weight = weight_values[:, 2] * model.env_strength
+
+        # Event-driven time advance, the calendar is built over the respondents of the media table
+        self.calendar = None
+        if time_advance == "event":
+            media = model.survey["media"]
+            self.calendar = EventCalendar(model, model.media_weight_trust * media[:, :-5], media[:, :5])
+        self.quiet_until = 0 # Last step of the current quiet stretch
+        self.advanced_to = 0 # Step the state of the agents is up to date with
+        self._quiet_counts = None # Phase counts during the quiet stretch
+
+    def active(self):
+        """Returns the indices of the agents that have not implemented a protective action yet."""
+        return self.active_idx
+
+    def compact(self):
+        """
+        Removes the agents that implemented a protective action from the active set. Once the active set has
+        shrunk to PRUNE_FRACTION of its size at the last pruning, the departed agents are also pruned from the
+        communication operators, so the rebuilds cost O(edges) in total over a run.
+        """
+        self.active_idx = self.active_idx[self.phase[self.active_idx] < 3]
+        if len(self.active_idx) <= PRUNE_FRACTION * self._pruned_size:
+            keep = np.zeros(self.size, dtype=bool)
+            keep[self.active_idx] = True
+            self.acquaintances = prune_operator(self.acquaintances, keep)
+            self.neighbours = prune_operator(self.neighbours, keep)
+            self._pruned_size = len(self.active_idx)
+
+    def phase_counts(self):
+        """
+        Number of active agents in phase 0, 1 and 2, as an array of 3 or, when the population holds several
+        replicates, as a (replicate x 3) array.
+        """
+        if self.quiet_until >= self.model.steps and self._quiet_counts is not None:
+            return self._quiet_counts # Nobody changes phase during a quiet stretch
+        idx = self.active_idx
+        counts = np.bincount(self.replicate[idx] * 3 + self.phase[idx],
+                             minlength=self.n_replicates * 3).reshape(self.n_replicates, 3)
+        return counts[0] if self.n_replicates == 1 else counts
+
+    def per_replicate(self, idx):
+        """Number of agents in idx, per replicate when the population holds several replicates."""
+        if self.n_replicates == 1:
+            return len(idx)
+        return np.bincount(self.replicate[idx], minlength=self.n_replicates)
+
+    def decision_draws(self, idx):
+        """
+        Draws the decisions of the agents in idx. Stacked replicates draw from their own stream, in the order
+        of their agents, so every replicate makes the decisions of the single run with its seed.
+        """
+        if self.decision_streams is None:
+            return self.model.decision_draws(len(idx))
+        # The active indices are sorted, so the agents of a replicate form one block of idx
+        counts = np.bincount(self.replicate[idx], minlength=self.n_replicates)
+        return np.concatenate([self.model.decision_draws(count, stream)
+                               for count, stream in zip(counts.tolist(), self.decision_streams)])
+
+    def get(self, attribute):
+        """Returns the values of an attribute for the active agents, like `AgentSet.get` does for agents."""
+        self.advance()
+        return getattr(self, attribute)[self.active()]
+
+    def calc_risk_perception(self, idx):
+        """
+        Calculate the current cue perception (part of risk perception) as a weighted combination of environmental
+        cues (wind, rain), media cues.
+        """
+        self.cue_perception[idx] = (self.env_weight[idx] * (self.wind_cue[idx] + self.rain_cue[idx])
+                                    + self.model.media_weight_perc * self.media_cue[idx])
+
+    def calc_media_cue(self, idx):
+        """
+        Update the media cue of the agents based on frequency and trust toward media.
+        """
+        media_comm = self.model.steps % self.media_freq[idx] == 0
+        raw_increment = (self.media_trust[idx] * media_comm).sum(axis=1) / 5
+        self.media_cue[idx] = np.minimum(self.media_cue[idx] + raw_increment, 1)
+
+    def received(self, operator, idx, values=None):
+        """
+        Sums what the agents in idx send over a communication operator. Only the rows of the senders are used and
+        only the receivers are returned, so the cost scales with the edges of the senders instead of the
+        population.
+
+        Args:
+            operator (scipy.sparse.csr_matrix): Sender x receiver operator.
+            idx (numpy.ndarray): Indices of the sending agents.
+            values (numpy.ndarray, optional): Values sent by each agent in idx, one row per sender.
+                Every sender sends 1 if not given.
+
+        Returns:
+            tuple: Indices of the receiving agents and the received sum per receiver, with the trailing shape
+            of values.
+        """
+        rows = operator[idx]
+        receivers, position = np.unique(rows.indices, return_inverse=True)
+        sent = rows.data
+        if values is not None:
+            sender = np.repeat(np.arange(len(idx)), np.diff(rows.indptr))
+            sent = sent.reshape((-1,) + (1,) * (values.ndim - 1)) * values[sender]
+        sums = np.zeros((len(receivers),) + sent.shape[1:])
+        np.add.at(sums, position, sent)
+        return receivers, sums
+
+    def phase_change_communication(self, idx):
+        """
+        Increase social perception of the acquaintances of the agents in idx to reflect a communicated phase change.
+        """
+        receivers, count = self.received(self.acquaintances, idx)
+        self.social_perception[receivers] += self.model.phase_change_factor * count
+
+    def risk_identification(self, idx):
+        """
+        Phase 0: Determine which agents have a risk perception above the identification threshold.
+        These agents notify their acquaintances and move to the next phase.
+        """
+        self.calc_risk_perception(idx)
+        changed = idx[self.risk_perception[idx] >= self.RI_thresh[idx]]
+        self.phase_change_communication(changed)
+        self.phase[changed] = 1
+
+    def risk_assessment(self, idx):
+        """
+        Phase 1: Assess which agents have a risk perception above the risk assessment threshold.
+        These agents notify their acquaintances, search for the best action and proceed to the action phase.
+        """
+        self.calc_risk_perception(idx)
+        changed = idx[self.risk_perception[idx] > self.RA_thresh[idx]]
+        self.phase_change_communication(changed)
+        self.protective_action_search(changed)
+        self.phase[changed] = 2
+
+    def protective_action_search(self, idx):
+        """
+        Read the probabilities of each protective action for the agents in idx from the probabilities the model
+        computed with the multinominal logistic regression, and record their preferred option.
+        """
+        self.attitudes[idx] = self.model.action_probabilities[idx]
+        self.preferred_evac[idx] = self.attitudes[idx].argmax(axis=1)
+
+    def protective_action_assessment(self, idx):
+        """
+        Phase 2: Determine the propensity (immediacy) of the agents to implement their protective action and draw
+        which of them act in this step. Acting agents communicate their choice and leave the population.
+        """
+        self.immediacy[idx] = np.minimum(self.immediacy_cum[idx] + self.immediacy_base, 1)
+        self.calc_risk_perception(idx)
+        prob_action = self.immediacy[idx]
+        draws = self.decision_draws(idx)
+        acting = idx[(prob_action > self.model.min_probability_threshold) & (draws < prob_action)]
+
+        self.Protective_Action_Implementation_communication(acting)
+        self.phase[acting] = 3
+        choice = self.preferred_evac[acting]
+        self.model.evaced_agents += self.per_replicate(acting)
+        self.model.friends_choice += self.per_replicate(acting[choice == 0])
+        self.model.hotel_choice += self.per_replicate(acting[choice == 1])
+        self.model.shelter_choice += self.per_replicate(acting[choice == 2])
+        self.model.stay_choice += self.per_replicate(acting[choice == 3])
+
+    def Protective_Action_Implementation_communication(self, idx):
+        """
+        Communicate the protective action implementation of the agents in idx to their acquaintances and
+        neighbours, influencing their action preference and propensity.
+        """
+        # One-hot encoding of the preferred action of every sender
+        choice = np.zeros((len(idx), len(ACTIONS)))
+        choice[np.arange(len(idx)), self.preferred_evac[idx]] = 1
+        receivers, received = self.received(self.acquaintances, idx, choice)
+        self.attitudes[receivers] += self.model.action_comm_value * received
+        # Every sender sends one choice, so the row sums count the senders
+        self.immediacy_cum[receivers] += self.model.action_comm_value_imm * received.sum(axis=1)
+
+        # Only agents that leave their home are seen by their neighbours
+        leaving = idx[self.preferred_evac[idx] != ACTIONS.index("stay")]
+        receivers, seen = self.received(self.neighbours, leaving)
+        self.attitudes[receivers, :3] += self.model.action_comm_value * seen[:, None]
+        self.immediacy_cum[receivers] += self.model.action_comm_value_imm * seen
+
+    def storm_surge_communication(self, idx):
+        """Update the perceptions of the agents in idx whose tract got a storm surge watch or warning."""
+        self.social_perception[idx] += self.model.comm_watch_value_risk
+        self.immediacy_cum[idx] += self.model.comm_warning_value_imm
+
+    def government_warning_communication(self, comm_value_risk, comm_value_immediacy):
+        """Update the perceptions of the active agents based on government communications."""
+        self.advance()
+        idx = self.active()
+        self.social_perception[idx] += comm_value_risk
+        self.immediacy_cum[idx] += comm_value_immediacy
+
+    def step(self):
+        """
+        Batched counterpart of `Individual.step`. Updates the cues and risk perception of all active agents and
+        calls the method of each phase once for all agents in that phase.
+
+        `Individual.general_communication` averages the agent's own attribute over its acquaintances, so it returns
+        the attribute unchanged. The batched step therefore has no counterpart for it.
+        """
+        model = self.model
+        n_steps = model.steps
+        if self.calendar is not None:
+            if n_steps <= self.quiet_until:
+                return
+            self.advance(n_steps - 1)
+        idx = self.active()
+        tract = self.tract[idx]
+        # Phases are read before any method runs, so agents advance at most one phase per step
+        phase = self.phase[idx]
+
+        # Without agents in phase 2 the step may start a quiet stretch, which ends at the latest at a government
+        # warning and before the last step
+        if self.calendar is not None and not (phase == 2).any():
+            last = min(self.calendar.next_warning(n_steps), model.number_of_steps - 1)
+            threshold = np.where(phase == 0, self.RI_thresh[idx], self.RA_thresh[idx])
+            end = self.calendar.quiet_until(n_steps, last, tract, self.media_rows[idx], self.env_weight[idx],
+                                            self.cue_perception[idx], self.social_perception[idx], threshold,
+                                            model.media_weight_perc)
+            if end >= n_steps:
+                self._quiet_counts = self.phase_counts()
+                self.quiet_until = end
+                return
+
+        self.risk_perception[idx] = np.minimum(self.cue_perception[idx] + self.social_perception[idx], 1)
+        self.immediacy_base = model.base_immediacy(n_steps)
+
+        self.rain_cue[idx] = model.rain[tract, n_steps - 1]
+        self.calc_media_cue(idx)
+        if n_steps % 3 == 0:
+            old_value = self.storm_surge_state[idx]
+            new_value = model.storm_surge[tract, int(n_steps / 3) + 1]
+            # A watch or warning is communicated when the state rises from none to watch/warning or watch to warning
+            raised = (((old_value == 0) & ((new_value == 0.5) | (new_value == 1)))
+                      | ((old_value == 0.5) & (new_value == 1)))
+            self.storm_surge_state[idx] = new_value
+            self.storm_surge_communication(idx[raised])
+            self.wind_cue[idx] = model.wind[tract, int(n_steps / 3) - 1]
+
+        self.risk_identification(idx[phase == 0])
+        self.risk_assessment(idx[phase == 1])
+        self.protective_action_assessment(idx[phase == 2])
+        self.compact()
+        self.advanced_to = n_steps
+
+    def advance(self, step=None):
+        """
+        Brings the state of the agents up to date after a quiet stretch, up to the given step (by default the
+        current one) or the end of the stretch. Nobody communicates or decides during the stretch, so the state
+        follows from the event calendar; it is computed as the skipped steps would have computed it.
+        """
+        step = min(self.model.steps if step is None else step, self.quiet_until)
+        if self.calendar is None or step <= self.advanced_to:
+            return
+        calendar = self.calendar
+        idx = self.active()
+        tract = self.tract[idx]
+        rows = self.media_rows[idx]
+
+        # Storm surge raises before the last step, in order
+        for raise_step in calendar.raise_steps:
+            if self.advanced_to < raise_step < step:
+                self.storm_surge_communication(idx[calendar.raised[tract, raise_step]])
+
+        # Risk perception of the last step uses the cue perception of the step before it
+        if step - 1 > self.advanced_to:
+            cue_perception = (self.env_weight[idx] * (calendar.wind[tract, step - 1] + calendar.rain[tract, step - 1])
+                              + self.model.media_weight_perc * calendar.media[rows, step - 1])
+        else:
+            cue_perception = self.cue_perception[idx]
+        self.risk_perception[idx] = np.minimum(cue_perception + self.social_perception[idx], 1)
+        self.immediacy_base = self.model.base_immediacy(step)
+        if step in calendar.raise_steps:
+            self.storm_surge_communication(idx[calendar.raised[tract, step]])
+
+        self.rain_cue[idx] = calendar.rain[tract, step]
+        self.wind_cue[idx] = calendar.wind[tract, step]
+        self.storm_surge_state[idx] = calendar.storm_surge[tract, step]
+        self.media_cue[idx] = calendar.media[rows, step]
+        self.calc_risk_perception(idx)
+        self.advanced_to = step
+
+
+class PopulationSnapshot:
+    """
+    A built population that can be reused by several models: the acquaintance graph, living areas, households,
+    closest neighbours and bootstrapped survey rows. All arrays are made read only and are shared by the models
+    created from the snapshot; every model allocates its own agent state, so running never changes them.
+    """
+
+    def __init__(self, state, county, n_neighbors, household_placement, G, tracts, tract, agent_xy, tract_tree,
+                 neighbour_table, survey_rows, media_rows):
+        self.state = state
+        self.county = county
+        self.n_neighbors = n_neighbors
+        self.household_placement = household_placement
+        self.G = G # Watts Strogatz graph of acquaintances, a networkx graph or a CSR adjacency matrix
+        self.acquaintances = acquaintance_operator(G) # CSR operator of the graph
+        self.tracts = tracts # Tract data, cues and polygons
+        self.tract = tract # Tract index of every agent
+        self.agent_xy = agent_xy # Location of every agent
+        self.tract_tree = tract_tree # Spatial index over the tract centroids
+        self.neighbour_table = neighbour_table # Closest neighbours of every agent (agent x n_neighbors)
+        # An evacuating agent is seen by the agents it has as closest neighbours
+        self.neighbours = communication_operator(np.repeat(np.arange(len(tract)), n_neighbors),
+                                                 neighbour_table.ravel(), len(tract))
+        self.survey_rows = survey_rows # Bootstrapped respondents of the predictor and weight tables
+        self.media_rows = media_rows # Bootstrapped respondents of the media table
+
+        for values in (tract, agent_xy, neighbour_table, survey_rows, media_rows,
+                       self.acquaintances.data, self.acquaintances.indices, self.acquaintances.indptr,
+                       self.neighbours.data, self.neighbours.indices, self.neighbours.indptr):
+            values.flags.writeable = False
+
+    @property
+    def size(self):
+        """Number of agents in the population."""
+        return len(self.tract)
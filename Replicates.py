@@ -0,0 +1,164 @@
+"""
+Replicates.py
+
+Defines `ReplicateBatch`, which runs R replicates of the `EvacuationDec` model in lockstep in one process.
+Every replicate gets its own population (acquaintance graph, living areas, neighbours and bootstrapped survey
+rows) and its own stream of action decisions. The populations are stacked into one array-backed `Population` of R x N agents with block diagonal
+communication operators, so agents only communicate within their own replicate, and one step updates all
+replicates at once. The Python overhead of a step is therefore paid once instead of R times.
+
+Model reporters are collected per replicate as (step x replicate) arrays. Agent reporters are not collected.
+
+Dependencies:
+    - numpy: numerical operations
+    - pandas: export of the collected data
+    - scipy: block diagonal communication operators
+    - Model: the EvacuationDec model the replicates are built from
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from Model import EvacuationDec
+from Population import Population
+from helper_functions import spawn_streams, survey_action_probabilities
+from run_config import data_collection_attributes
+
+# Counters of the model that are kept per replicate
+COUNTERS = ("evaced_agents", "average_evac_time", "hotel_choice", "friends_choice", "shelter_choice",
+            "stay_choice", "phase_0", "phase_1", "phase_2")
+
+
+class ReplicateBatch:
+    def __init__(self, n_replicates, seed=None, outcome_collection="convergence", run=True, **kwargs):
+        """
+        Args:
+            n_replicates (int): Number of replicates R.
+            seed (int, optional): Seed of the batch, the seeds of the replicates are drawn from it.
+            outcome_collection (str): Setting of run_config, only the model reporters are collected.
+            run (bool): Runs the replicates directly after creation.
+            **kwargs: Any other argument of EvacuationDec, equal for all replicates.
+        """
+        self.n_replicates = n_replicates
+        reporters = data_collection_attributes(outcome_collection)[1]
+        functions = [name for name, reporter in reporters.items() if not isinstance(reporter, str)]
+        if functions:
+            raise ValueError(f"Model reporters {functions} are functions of the model, which are not "
+                             f"collected per replicate; use a setting with attribute reporters only")
+        self.model_reporters = reporters
+
+        # Every replicate gets its own seed; the population of replicate r is the one EvacuationDec builds with
+        # seed seeds[r] and its decisions are drawn from the decision stream of that seed, so a replicate can be
+        # reproduced (and paired with) a single run
+        self.seeds = np.random.SeedSequence(seed).generate_state(n_replicates, dtype=np.uint64).tolist()
+
+        # The model holds the parameters and builds the population of every replicate
+        self.model = model = EvacuationDec(engine="array", run=False, seed=self.seeds[0],
+                                           outcome_collection=outcome_collection, **kwargs)
+        first = model.snapshot()
+        snapshots = [first] + [model.build_population(first.state, first.county, first.size,
+                                                      model.node_connectivity, first.n_neighbors,
+                                                      first.household_placement, spawn_streams(replicate_seed),
+                                                      kwargs.get("stratified_bootstrap", False), model.network)
+                               for replicate_seed in self.seeds[1:]]
+        self.n_agents = model.population_snapshot.size
+
+        # Stacks the replicates, agent i of replicate r is agent r * N + i of the stacked population
+        survey_rows = np.concatenate([snapshot.survey_rows for snapshot in snapshots])
+        media_rows = np.concatenate([snapshot.media_rows for snapshot in snapshots])
+        tract = np.concatenate([snapshot.tract for snapshot in snapshots])
+        acquaintances = sparse.block_diag([snapshot.acquaintances for snapshot in snapshots], format="csr")
+        neighbours = sparse.block_diag([snapshot.neighbours for snapshot in snapshots], format="csr")
+        replicate = np.repeat(np.arange(n_replicates), self.n_agents)
+
+        model.action_probabilities = survey_action_probabilities()[survey_rows]
+        for name in COUNTERS:
+            setattr(model, name, np.zeros(n_replicates, dtype=np.int64))
+        model.population = Population(model, survey_rows, media_rows, tract, acquaintances, neighbours,
+                                      replicate=replicate, n_replicates=n_replicates,
+                                      time_advance=model.time_advance,
+                                      decision_streams=[model.streams["decisions"]]
+                                      + [spawn_streams(replicate_seed)["decisions"]
+                                         for replicate_seed in self.seeds[1:]])
+
+        self.running = True
+        self.collected = 0
+        self.steps = np.zeros(model.number_of_steps, dtype=np.int64)
+        self._buffers = {name: np.zeros((model.number_of_steps, n_replicates), dtype=np.int64)
+                         for name in self.model_reporters}
+        self._evacuated = np.zeros((model.number_of_steps, n_replicates), dtype=np.int64)
+
+        if run:
+            self.run_model()
+
+    def run_model(self):
+        """Steps all replicates until the model stops."""
+        while self.running:
+            self.step()
+
+    def step(self):
+        """Counterpart of `EvacuationDec.step` for the stacked replicates."""
+        model = self.model
+        population = model.population
+        model.steps += 1
+
+        # Counts how many agents of every replicate are in each phase and updates all phases as a batch
+        counts = np.atleast_2d(population.phase_counts()) # (replicate x 3), also for a single replicate
+        model.phase_0, model.phase_1, model.phase_2 = counts[:, 0], counts[:, 1], counts[:, 2]
+        population.step()
+
+        # Calculates the average evacuation time of every replicate at the last model step and stops
+        if model.steps == model.number_of_steps:
+            evacs_per_step = self._evacuated[:self.collected]
+            numerator = ((np.arange(self.collected) + 1)[:, None] * evacs_per_step).sum(axis=0)
+            denominator = evacs_per_step.sum(axis=0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                model.average_evac_time = np.where(denominator > 0, numerator / denominator, np.nan)
+            self.running = False
+
+        # Issues Hurricane watch and warning at correct steps
+        if model.steps == model.trop_warning_step:
+            model.government_warning_communication(model.comm_watch_value_risk, model.comm_watch_value_risk)
+        elif model.steps == model.evac_warning_step:
+            model.government_warning_communication(model.comm_warning_value_risk, model.comm_warning_value_imm)
+
+        self.collect()
+        model.evaced_agents = np.zeros(self.n_replicates, dtype=np.int64)
+
+    def collect(self):
+        """Collects the model reporters of every replicate."""
+        if self.collected == len(self.steps):
+            self.steps = np.concatenate([self.steps, np.zeros_like(self.steps)])
+            self._evacuated = np.concatenate([self._evacuated, np.zeros_like(self._evacuated)])
+            for name, buffer in self._buffers.items():
+                self._buffers[name] = np.concatenate([buffer, np.zeros_like(buffer)])
+        row = self.collected
+        self.steps[row] = self.model.steps
+        self._evacuated[row] = self.model.evaced_agents
+        for name, attribute in self.model_reporters.items():
+            values = np.asarray(getattr(self.model, attribute))
+            if values.dtype.kind == "f" and self._buffers[name].dtype.kind == "i":
+                self._buffers[name] = self._buffers[name].astype(float)
+            self._buffers[name][row] = values
+        self.collected += 1
+
+    def model_columns(self):
+        """Returns the collected steps and model reporters: "Step" plus one (step x replicate) array per reporter."""
+        return {"Step": self.steps[:self.collected],
+                **{name: buffer[:self.collected] for name, buffer in self._buffers.items()}}
+
+    def replicate_columns(self, replicate):
+        """
+        Returns the columns of one replicate in the layout of `ArrayDataCollector.model_columns`, so it can be
+        written to a ResultStore or added to a StepAggregator like a single run.
+        """
+        return {"Step": self.steps[:self.collected],
+                **{name: buffer[:self.collected, replicate] for name, buffer in self._buffers.items()}}
+
+    def get_model_vars_dataframe(self):
+        """
+        Returns:
+            pandas.DataFrame: One row per replicate and step with the model reporters.
+        """
+        return pd.concat([pd.DataFrame({"Replicate": replicate, **self.replicate_columns(replicate)})
+                          for replicate in range(self.n_replicates)], ignore_index=True)
@@ -0,0 +1,232 @@
+"""
+ResultCache.py
+
+Defines the `ResultCache`, an on-disk cache of model runs. A run is identified by a hash of the complete
+argument set of the model (defaults included), its seed and the content hashes of the input data: the survey
+tables, the logistic model and the tract data. A run that is already in the cache is returned without
+running the simulation, so parameter points that are part of many sweeps (e.g. the base scenario) are only
+simulated once.
+
+Only seeded runs are cached, a run without seed can not be reproduced. The cache is bounded in size: when
+it grows beyond max_bytes the least recently used runs are removed. Runs on outdated input data are never
+returned, and prune_stale removes them. The size of the cache is counted once when it is opened and kept up to
+date as runs are stored and removed, so the entries are only scanned when the cache has to shrink.
+
+Dependencies:
+    - numpy: numerical operations
+    - helper_functions: columnar table format and file fingerprints
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+import numpy as np
+from helper_functions import file_fingerprint, load_columns, save_columns
+
+# Input data of the model, the cache key includes the content hash of every file
+INPUT_FILES = (
+    "regression models/reg_results_FINAL/preditor_data.csv",
+    "regression models/reg_results_FINAL/weights.csv",
+    "regression models/reg_results_FINAL/media_weights.csv",
+    "regression models/reg_results_FINAL/finalized_model.sav",
+)
+
+# Arguments that do not change the output of a run
+IGNORED_ARGUMENTS = ("self", "run", "topology_cache", "time_advance")
+
+
+def input_fingerprints(state, county):
+    """
+    Returns the content hash of every input file of the model, None for files that do not exist.
+
+    Args:
+        state (str): State of the tract data.
+        county (str): County of the tract data.
+    """
+    paths = INPUT_FILES + (f"./ACSDATA/{[state]}{[county]}/data.gpkg",)
+    return {path: file_fingerprint(path) if os.path.isfile(path) else None for path in paths}
+
+
+class ResultCache:
+    def __init__(self, root, max_bytes=2 ** 30):
+        """
+        Args:
+            root (str): Directory of the cache, created if it does not exist.
+            max_bytes (int): Size the cache is kept below by removing the least recently used runs.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size, _ in self.entries()) # Size of all cached runs
+
+    def describe(self, model_cls, kwargs):
+        """
+        Returns everything the output of a run depends on, or None if the run can not be cached.
+
+        Args:
+            model_cls: The model class.
+            kwargs (dict): Arguments of the model, including the seed.
+
+        Returns:
+            dict: The model, its complete arguments (defaults included) and the input fingerprints. None when
+            the run has no seed or is built on a population snapshot.
+        """
+        arguments = inspect.signature(model_cls.__init__).bind(None, **kwargs)
+        arguments.apply_defaults()
+        arguments = {name: value for name, value in arguments.arguments.items() if name not in IGNORED_ARGUMENTS}
+        if arguments.get("seed") is None or arguments.get("snapshot") is not None:
+            return None
+        return {
+            "model": f"{model_cls.__module__}.{model_cls.__qualname__}",
+            "arguments": json.loads(json.dumps({name: value.item() if isinstance(value, np.generic) else value
+                                                for name, value in arguments.items()}, default=str)),
+            "inputs": input_fingerprints(arguments.get("state"), arguments.get("county")),
+        }
+
+    @staticmethod
+    def key(content):
+        """Returns the cache key of a run described by describe, the SHA-256 hash of the description."""
+        if content is None:
+            return None
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        """Directory of a cached run."""
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, content, agents=False):
+        """
+        Looks up a run.
+
+        Args:
+            content (dict): Description of the run, see describe.
+            agents (bool): The agent reporters are needed as well.
+
+        Returns:
+            dict: "columns" and "agent_columns" of the run as in BatchRunner results, or None on a miss.
+        """
+        key = self.key(content)
+        data, _ = load_columns(self.path(key), mmap=False) if key is not None else (None, None)
+        if data is None or (agents and "agent.present" not in data):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(os.path.join(self.path(key), "manifest.json")) # Marks the run as recently used
+        columns = {name: values for name, values in data.items() if not name.startswith("agent.")}
+        agent_columns = {name[len("agent."):]: values for name, values in data.items() if name.startswith("agent.")}
+        return {"columns": columns, "agent_columns": agent_columns if agents else None}
+
+    def put(self, content, columns, agent_columns=None):
+        """
+        Stores a run and removes the least recently used runs if the cache grows beyond max_bytes.
+
+        Args:
+            content (dict): Description of the run, see describe. Nothing is stored if None.
+            columns (dict): Model level output, "Step" plus one array per reporter.
+            agent_columns (dict, optional): Agent level output.
+        """
+        if content is None:
+            return
+        columns = dict(columns)
+        for name, values in (agent_columns or {}).items():
+            columns[f"agent.{name}"] = values
+        path = self.path(self.key(content))
+        self.total_bytes -= self.size(path) # A run that is stored again replaces its old entry
+        save_columns(path, columns, {**content, "created": time.time()})
+        self.total_bytes += self.size(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def run(self, model_cls, agents=False, **kwargs):
+        """
+        Returns the output of a run from the cache, running and storing it on a miss.
+
+        Args:
+            model_cls: The model class.
+            agents (bool): Also return the agent reporters.
+            **kwargs: Arguments of the model, including the seed.
+
+        Returns:
+            dict: "columns" and "agent_columns" of the run as in BatchRunner results.
+        """
+        content = self.describe(model_cls, kwargs)
+        result = self.get(content, agents)
+        if result is None:
+            model = model_cls(**kwargs)
+            while model.running:
+                model.step()
+            collector = model.datacollector
+            result = {"columns": collector.model_columns(),
+                      "agent_columns": collector.agent_columns() if agents else None}
+            self.put(content, result["columns"], result["agent_columns"])
+        return result
+
+    @staticmethod
+    def size(path):
+        """Size in bytes of a cached run, 0 if it does not exist."""
+        return sum(entry.stat().st_size for entry in os.scandir(path)) if os.path.isdir(path) else 0
+
+    def entries(self):
+        """
+        Yields:
+            tuple: Directory, metadata, size in bytes and last use of every cached run.
+        """
+        for prefix in os.listdir(self.root):
+            prefix_path = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                path = os.path.join(prefix_path, key)
+                manifest = os.path.join(path, "manifest.json")
+                if ".tmp" in key or not os.path.isfile(manifest):
+                    continue
+                with open(manifest) as file:
+                    meta = json.load(file)["meta"]
+                yield path, meta, self.size(path), os.path.getmtime(manifest)
+
+    def evict(self):
+        """
+        Removes the least recently used runs until the cache is below max_bytes. Scans all entries, which also
+        recounts the size of the cache in case other processes changed it.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[3])
+        total = sum(entry[2] for entry in entries)
+        for path, _, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        self.total_bytes = total
+
+    def invalidate(self, where=None):
+        """
+        Removes cached runs.
+
+        Args:
+            where (dict or callable, optional): Only remove runs with these argument values, or for which the
+                function returns True when given the arguments. All runs are removed if not given.
+        """
+        for path, meta, size, _ in list(self.entries()):
+            arguments = meta["arguments"]
+            if callable(where) and not where(arguments):
+                continue
+            if isinstance(where, dict) and any(arguments.get(name) != value for name, value in where.items()):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            self.total_bytes -= size
+
+    def prune_stale(self):
+        """Removes the runs that were made on input data that has changed since."""
+        current = {}
+        for path, meta, size, _ in list(self.entries()):
+            files = tuple(meta["inputs"])
+            if files not in current:
+                current[files] = {file: file_fingerprint(file) if os.path.isfile(file) else None for file in files}
+            if meta["inputs"] != current[files]:
+                shutil.rmtree(path, ignore_errors=True)
+                self.total_bytes -= size
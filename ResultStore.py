@@ -0,0 +1,260 @@
+"""
+ResultStore.py
+
+Defines the `ResultStore`, a result sink for batch runs of the `EvacuationDec` model. Every run is written
+as soon as it finishes, as its own partition of a columnar store:
+
+    <root>/<scenario>/<parameter set>/<RunId>/<column>.npy
+
+Reads only open the partitions that match the requested scenario and parameters, and only load the
+requested columns and steps from the memory-mapped files. Per step summaries of a scenario are stored in
+<root>/<scenario>.summary. Memory use therefore does not grow with the
+number of runs, and loading e.g. the final step of every run stays fast.
+
+Dependencies:
+    - numpy: numerical operations
+    - pandas: export of the stored data
+    - BatchRunner: parallel runs
+    - helper_functions: columnar table format
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from BatchRunner import batch_run
+from helper_functions import load_columns, save_columns
+
+
+def to_builtin(value):
+    """Converts numpy scalars and arrays to Python values, so parameters can be stored as JSON."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+def parameter_key(params):
+    """
+    Returns the name of the partition of a parameter set, a short hash of the parameters.
+
+    Args:
+        params (dict): Model parameters of a run.
+
+    Returns:
+        str: Partition name, equal for equal parameter sets.
+    """
+    text = json.dumps({name: to_builtin(value) for name, value in params.items()}, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+class ResultStore:
+    def __init__(self, root):
+        """
+        Args:
+            root (str): Directory of the store, created if it does not exist.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def run_path(self, scenario, params, run_id):
+        """Directory of the partition of one run."""
+        return os.path.join(self.root, str(scenario), parameter_key(params), str(run_id))
+
+    def write(self, scenario, run_id, iteration, params, columns, agent_columns=None):
+        """
+        Writes the output of one run as its own partition.
+
+        Args:
+            scenario (str): Name of the scenario or experiment.
+            run_id (int): Id of the run, unique within the scenario and parameter set.
+            iteration (int): Iteration (replicate) number of the run.
+            params (dict): Model parameters of the run.
+            columns (dict): Model level output, "Step" plus one array per reporter.
+            agent_columns (dict, optional): Agent level output, (step x agent) arrays plus the "present" mask.
+        """
+        columns = dict(columns)
+        for name, values in (agent_columns or {}).items():
+            columns[f"agent.{name}"] = values
+        meta = {
+            "scenario": str(scenario),
+            "RunId": to_builtin(run_id),
+            "iteration": to_builtin(iteration),
+            "params": {name: to_builtin(value) for name, value in params.items()},
+        }
+        save_columns(self.run_path(scenario, params, run_id), columns, meta)
+
+    def write_model(self, scenario, run_id, iteration, params, model, agents=False):
+        """
+        Writes the collected data of a finished model.
+
+        Args:
+            agents (bool): Also write the agent reporters, otherwise only the model reporters are stored.
+        """
+        collector = model.datacollector
+        self.write(scenario, run_id, iteration, params, collector.model_columns(),
+                   collector.agent_columns() if agents else None)
+
+    def runs(self, scenario=None, where=None):
+        """
+        Finds the stored runs. The scenario prunes whole directories, the parameter filter is checked on the
+        manifests, so no column data is read.
+
+        Args:
+            scenario (str, optional): Only runs of this scenario.
+            where (dict or callable, optional): Parameter values runs must have, or a function that is given
+                the parameters of a run and returns whether it is selected.
+
+        Yields:
+            tuple: Directory and metadata of every selected run.
+        """
+        scenarios = [str(scenario)] if scenario is not None else sorted(os.listdir(self.root))
+        for name in scenarios:
+            scenario_path = os.path.join(self.root, name)
+            if not os.path.isdir(scenario_path) or name.endswith(".summary"):
+                continue
+            for key in sorted(os.listdir(scenario_path)):
+                key_path = os.path.join(scenario_path, key)
+                for run_id in sorted(os.listdir(key_path), key=lambda name: (len(name), name)):
+                    path = os.path.join(key_path, run_id)
+                    manifest = os.path.join(path, "manifest.json")
+                    if ".tmp" in run_id or not os.path.isfile(manifest):
+                        continue # Run that is still being written
+                    with open(manifest) as file:
+                        meta = json.load(file)["meta"]
+                    if callable(where) and not where(meta["params"]):
+                        continue
+                    if isinstance(where, dict) and any(meta["params"].get(name) != value
+                                                       for name, value in where.items()):
+                        continue
+                    yield path, meta
+
+    def read(self, columns=None, scenario=None, where=None, step=None, params=True):
+        """
+        Reads model level output of the selected runs into one DataFrame, one row per run and step.
+
+        Args:
+            columns (list of str, optional): Reporters to load, all model reporters if not given.
+            scenario (str, optional): Only runs of this scenario.
+            where (dict or callable, optional): Parameter filter, see runs.
+            step (int, list of int or "last", optional): Only these steps, or the final step of every run.
+            params (bool): Add the parameters of the run as columns, like batch_run does.
+
+        Returns:
+            pandas.DataFrame: Columns RunId, iteration, scenario, Step, the parameters and the reporters.
+        """
+        frames = []
+        for path, meta in self.runs(scenario, where):
+            data, _ = load_columns(path)
+            rows = self._rows(data["Step"], step)
+            names = columns if columns is not None else [name for name in data
+                                                         if name != "Step" and not name.startswith("agent.")]
+            frame = {"RunId": meta["RunId"], "iteration": meta["iteration"], "scenario": meta["scenario"],
+                     "Step": np.asarray(data["Step"][rows])}
+            if params:
+                frame.update(meta["params"])
+            frame.update({name: np.asarray(data[name][rows]) for name in names})
+            frames.append(pd.DataFrame(frame))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def read_agents(self, columns, scenario=None, where=None, step=None):
+        """
+        Reads agent level output of the selected runs into one DataFrame, one row per run, step and agent that
+        was in the model at that step. Only runs written with agent data are included.
+
+        Args:
+            columns (list of str): Agent reporters to load.
+            scenario, where, step: See read.
+
+        Returns:
+            pandas.DataFrame: Columns RunId, iteration, scenario, Step, AgentID and the agent reporters.
+        """
+        frames = []
+        for path, meta in self.runs(scenario, where):
+            data, _ = load_columns(path)
+            if "agent.present" not in data:
+                continue
+            rows = self._rows(data["Step"], step)
+            present = np.asarray(data["agent.present"][rows])
+            step_idx, agent_idx = np.nonzero(present)
+            frame = {"RunId": meta["RunId"], "iteration": meta["iteration"], "scenario": meta["scenario"],
+                     "Step": np.asarray(data["Step"][rows])[step_idx], "AgentID": agent_idx + 1}
+            frame.update({name: np.asarray(data[f"agent.{name}"][rows])[step_idx, agent_idx] for name in columns})
+            frames.append(pd.DataFrame(frame))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def write_summary(self, scenario, aggregator):
+        """
+        Writes the per step summary of a scenario, one table per parameter combination next to the runs:
+
+            <root>/<scenario>.summary/<parameter set>/<column>.npy
+
+        Args:
+            scenario (str): Name of the scenario.
+            aggregator (OnlineStats.StepAggregator): Aggregated replicates of the scenario.
+        """
+        for params, columns in aggregator.point_columns():
+            save_columns(os.path.join(self.root, f"{scenario}.summary", parameter_key(params)), columns,
+                         {"scenario": str(scenario), "params": {name: to_builtin(value)
+                                                                for name, value in params.items()}})
+
+    def read_summary(self, scenario, where=None, step=None):
+        """
+        Reads the per step summary of a scenario written by write_summary.
+
+        Args:
+            scenario (str): Name of the scenario.
+            where (dict or callable, optional): Parameter filter, see runs.
+            step (int, list of int or "last", optional): Only these steps, or the final step.
+
+        Returns:
+            pandas.DataFrame: One row per parameter combination and step with the parameters and the summary
+            columns.
+        """
+        summary_path = os.path.join(self.root, f"{scenario}.summary")
+        frames = []
+        for key in sorted(os.listdir(summary_path)) if os.path.isdir(summary_path) else []:
+            data, meta = load_columns(os.path.join(summary_path, key))
+            if data is None:
+                continue
+            if callable(where) and not where(meta["params"]):
+                continue
+            if isinstance(where, dict) and any(meta["params"].get(name) != value for name, value in where.items()):
+                continue
+            rows = self._rows(data["Step"], step)
+            frames.append(pd.DataFrame({**meta["params"],
+                                        **{name: np.asarray(values[rows]) for name, values in data.items()}}))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    @staticmethod
+    def _rows(steps, step):
+        """Row selection of a step filter."""
+        if step is None:
+            return slice(None)
+        if isinstance(step, str) and step == "last":
+            return slice(len(steps) - 1, len(steps))
+        return np.flatnonzero(np.isin(steps, np.atleast_1d(step)))
+
+
+def store_batch_run(model_cls, store, scenario, parameters, iterations=1, number_processes=1, agents=False,
+                    aggregator=None, raw=True, display_progress=True):
+    """
+    Batch runs a model like mesa's batch_run, but writes the output of every run to a ResultStore as soon
+    as the run finishes instead of collecting all results in memory. See BatchRunner.batch_run.
+
+    Args:
+        model_cls: The model class to batch-run.
+        store (ResultStore): Store the runs are written to.
+        scenario (str): Name of the scenario the runs are stored under.
+        parameters (dict): Model parameters, single values or iterables of values to combine.
+        iterations (int): Number of iterations for each parameter combination.
+        number_processes (int, optional): Number of processes, None uses all CPUs.
+        agents (bool): Also store the agent reporters.
+        aggregator (OnlineStats.StepAggregator, optional): Aggregates the runs, its summary is stored.
+        raw (bool): Store every run. With an aggregator, False stores only the summary.
+        display_progress (bool): Display batch run progress.
+    """
+    batch_run(model_cls, parameters, iterations=iterations, number_processes=number_processes, store=store,
+              scenario=scenario, agents=agents, aggregator=aggregator, raw=raw, display_progress=display_progress)
@@ -0,0 +1,52 @@
+"""
+Scheduler.py
+
+Defines the `PhaseScheduler`, the schedule of the agent engine. It replaces the shuffled step over mesa's
+AgentSet with a schedule that:
+    - Counts the agents per phase (0, 1, 2). Agents report their phase changes, so the number of agents per
+      phase is known without counting the population every step. Agents that implemented a protective action
+      are no longer counted.
+    - Computes the values that are equal for all agents once per step instead of once per agent.
+    - Steps the active agents in random order. The order matters: an agent that changes phase or implements a
+      protective action communicates to its acquaintances, which notice it in the same step when they come
+      later in the order. The order is drawn with the random generator of the model exactly as mesa's
+      shuffle_do draws it, so runs are unchanged. For the same reason the phases are not updated as separate
+      batches.
+
+Dependencies:
+    - none
+"""
+
+
+class PhaseScheduler:
+    def __init__(self, model, agents):
+        """
+        Args:
+            model: The EvacuationDec model.
+            agents (list of Individual): The agents in creation order, all in phase 0.
+        """
+        self.model = model
+        self.agents = list(agents) # Active agents in creation order, compacted after every step
+        self.phase_counts = [len(self.agents), 0, 0] # Number of active agents in phase 0, 1 and 2
+        self.immediacy_base = 0
+
+    def counts(self):
+        """Number of active agents in phase 0, 1 and 2."""
+        return tuple(self.phase_counts)
+
+    def move(self, agent, old_phase, new_phase):
+        """Counts an agent in its new phase, an agent in phase 3 is no longer counted."""
+        self.phase_counts[old_phase] -= 1
+        if new_phase < len(self.phase_counts):
+            self.phase_counts[new_phase] += 1
+
+    def step(self):
+        """Steps every active agent once, in random order."""
+        model = self.model
+        self.immediacy_base = model.base_immediacy(model.steps) # Only depends on the step
+
+        order = list(self.agents)
+        model.random.shuffle(order) # Same permutation as AgentSet.shuffle_do, which shuffles the same agents
+        for agent in order:
+            agent.step()
+        self.agents = [agent for agent in self.agents if agent.phase < 3]
@@ -0,0 +1,278 @@
+"""
+Sensitivity.py
+
+Global sensitivity analysis of the `EvacuationDec` model. Instead of varying one parameter at a time, the
+parameters are varied together over their ranges with one of two designs:
+    - Morris (elementary effects): r trajectories through a grid, one parameter changing per step. Cheap,
+      r * (k + 1) design points for k parameters, and ranks the parameters by influence.
+    - Sobol (Saltelli sampling): n * (k + 2) design points from a scrambled Sobol sequence. More expensive,
+      gives the first order and total effect indices: the share of the output variance caused by a
+      parameter alone and including its interactions.
+
+The design points are run with BatchRunner, and every design point is averaged over its iterations. The points
+that are compared in the indices (the points of a Morris trajectory, the rows of A, B and AB_i with the same base
+sample) run with common random numbers: iteration i of every point in such a group uses the same seed, so the
+differences between them are not dominated by replicate noise.
+
+Dependencies:
+    - numpy: numerical operations
+    - pandas: design and index tables
+    - scipy: Sobol sequences
+    - BatchRunner: parallel runs
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+from BatchRunner import batch_run
+
+
+def scale_design(unit, bounds):
+    """
+    Scales a design from the unit cube to the parameter ranges. Parameters with integer bounds are rounded.
+
+    Args:
+        unit (numpy.ndarray): Design in the unit cube (point x parameter).
+        bounds (dict): Parameter name to (low, high).
+
+    Returns:
+        pandas.DataFrame: One row per design point, one column per parameter.
+    """
+    design = pd.DataFrame(index=range(len(unit)))
+    for i, (name, (low, high)) in enumerate(bounds.items()):
+        values = low + unit[:, i] * (high - low)
+        if isinstance(low, (int, np.integer)) and isinstance(high, (int, np.integer)):
+            values = np.round(values).astype(int)
+        design[name] = values
+    return design
+
+
+def morris_design(bounds, trajectories=10, levels=4, seed=None):
+    """
+    Generates Morris trajectories. Every trajectory starts at a random grid point and changes the parameters
+    one at a time, in random order, by delta = levels / (2 * (levels - 1)) of their range.
+
+    Args:
+        bounds (dict): Parameter name to (low, high).
+        trajectories (int): Number of trajectories r.
+        levels (int): Number of grid levels p, even.
+        seed (int, optional): Seed of the design.
+
+    Returns:
+        tuple: The design as a DataFrame (r * (k + 1) points) and the design in the unit cube.
+    """
+    rng = np.random.default_rng(seed)
+    k = len(bounds)
+    delta = levels / (2 * (levels - 1))
+    grid = np.arange(levels) / (levels - 1)
+    unit = np.zeros((trajectories, k + 1, k))
+    for t in range(trajectories):
+        x = rng.choice(grid, size=k)
+        unit[t, 0] = x
+        for step, i in enumerate(rng.permutation(k)):
+            # Moves up when possible and down otherwise, picking randomly when both stay in the unit cube
+            up = x[i] + delta <= 1 + 1e-12 and (x[i] - delta < -1e-12 or rng.random() < 0.5)
+            x = x.copy()
+            x[i] += delta if up else -delta
+            unit[t, step + 1] = x
+    unit = unit.reshape(-1, k)
+    return scale_design(unit, bounds), unit
+
+
+def morris_indices(design, outputs, bounds, trajectories):
+    """
+    Computes the Morris indices from the outputs of a Morris design.
+
+    Args:
+        design (pandas.DataFrame): Design as returned by morris_design.
+        outputs (pandas.DataFrame): Output per design point, one column per metric.
+        bounds (dict): Parameter name to (low, high), in the order of the design.
+        trajectories (int): Number of trajectories of the design.
+
+    Returns:
+        pandas.DataFrame: Per metric and parameter: mu (mean elementary effect), mu_star (mean absolute
+        elementary effect) and sigma (standard deviation of the elementary effects). Effects are per unit of
+        the parameter range.
+    """
+    names = list(bounds)
+    k = len(names)
+    # Steps are measured on the design that was run, so the rounding of integer parameters is included
+    low, high = np.array(list(bounds.values()), dtype=float).T
+    unit = ((design[names].to_numpy(dtype=float) - low) / (high - low)).reshape(trajectories, k + 1, k)
+    changes = np.diff(unit, axis=1) # (trajectory x step x parameter), at most one nonzero per step
+    changed = np.abs(changes).argmax(axis=2)
+    step_size = np.take_along_axis(changes, changed[:, :, None], axis=2)[:, :, 0]
+    # A step that rounding reduced to nothing gives no elementary effect
+    trajectory, step = np.nonzero(step_size)
+
+    rows = []
+    for metric in outputs.columns:
+        y = outputs[metric].to_numpy(dtype=float).reshape(trajectories, k + 1)
+        effects = np.full((trajectories, k), np.nan)
+        effects[trajectory, changed[trajectory, step]] = np.diff(y, axis=1)[trajectory, step] / step_size[trajectory, step]
+        for i, name in enumerate(names):
+            rows.append({"metric": metric, "parameter": name, "mu": np.nanmean(effects[:, i]),
+                         "mu_star": np.nanmean(np.abs(effects[:, i])),
+                         "sigma": np.nanstd(effects[:, i], ddof=1)})
+    return pd.DataFrame(rows)
+
+
+def sobol_design(bounds, n=64, seed=None):
+    """
+    Generates a Saltelli design: matrices A and B from a scrambled Sobol sequence, followed by the k matrices
+    AB_i, which are A with column i taken from B.
+
+    Args:
+        bounds (dict): Parameter name to (low, high).
+        n (int): Number of base samples, preferably a power of 2.
+        seed (int, optional): Seed of the scrambling.
+
+    Returns:
+        tuple: The design as a DataFrame (n * (k + 2) points, in the order A, B, AB_1, ..., AB_k) and the
+        design in the unit cube.
+    """
+    k = len(bounds)
+    base = qmc.Sobol(d=2 * k, scramble=True, seed=seed).random(n)
+    a, b = base[:, :k], base[:, k:]
+    ab = np.repeat(a[None], k, axis=0)
+    ab[np.arange(k), :, np.arange(k)] = b.T
+    unit = np.concatenate([a, b, ab.reshape(-1, k)])
+    return scale_design(unit, bounds), unit
+
+
+def sobol_indices(outputs, names, n, n_bootstrap=100, seed=None):
+    """
+    Computes the first order (Saltelli 2010) and total effect (Jansen) Sobol indices from the outputs of a
+    Saltelli design, with bootstrap confidence intervals.
+
+    Args:
+        outputs (pandas.DataFrame): Output per design point, one column per metric.
+        names (list of str): Names of the parameters, in the order of the design.
+        n (int): Number of base samples of the design.
+        n_bootstrap (int): Number of bootstrap resamples for the confidence intervals.
+        seed (int, optional): Seed of the bootstrap.
+
+    Returns:
+        pandas.DataFrame: Per metric and parameter: S1 and ST with the half-width of their 95% confidence
+        interval (S1_conf, ST_conf).
+    """
+    k = len(names)
+    rng = np.random.default_rng(seed)
+    resamples = np.vstack([np.arange(n), rng.integers(n, size=(n_bootstrap, n))])
+
+    rows = []
+    for metric in outputs.columns:
+        y = outputs[metric].to_numpy(dtype=float)
+        f_a, f_b, f_ab = y[:n], y[n:2 * n], y[2 * n:].reshape(k, n)
+        # Every row of resamples gives one estimate, the first row is the estimate on the design itself
+        fa, fb, fab = f_a[resamples], f_b[resamples], f_ab[:, resamples]
+        variance = np.var(np.concatenate([fa, fb], axis=1), axis=1, ddof=1)
+        first = np.mean(fb * (fab - fa), axis=2) / variance
+        total = 0.5 * np.mean((fa - fab) ** 2, axis=2) / variance
+        for i, name in enumerate(names):
+            rows.append({"metric": metric, "parameter": name,
+                         "S1": first[i, 0], "S1_conf": 1.96 * np.std(first[i, 1:], ddof=1),
+                         "ST": total[i, 0], "ST_conf": 1.96 * np.std(total[i, 1:], ddof=1)})
+    return pd.DataFrame(rows)
+
+
+def run_design(model_cls, design, metrics, base_parameters=None, iterations=1, groups=None, seed=None,
+               **runner_kwargs):
+    """
+    Runs every point of a design and averages the final step value of the metrics over the iterations.
+
+    Args:
+        model_cls: The model class to run.
+        design (pandas.DataFrame): One row per design point, one column per parameter.
+        metrics (list of str): Model reporters used as outputs.
+        base_parameters (dict, optional): Parameters equal for all design points, e.g. outcome_collection.
+        iterations (int): Replicates per design point.
+        groups (sequence of int, optional): Group of every design point. Iteration i of all points of a group
+            runs with the same seed (common random numbers). Every run gets its own seed if not given.
+        seed (int, optional): Seed the run seeds are drawn from.
+        **runner_kwargs: Arguments of BatchRunner.batch_run, e.g. number_processes. With a store, the runs are
+            written to it and their final step values are read back from it, so an interrupted design can be
+            resumed through the ledger. raw=False is not accepted, the outputs are computed from the runs.
+
+    Returns:
+        pandas.DataFrame: Mean output per design point, one column per metric.
+    """
+    if not runner_kwargs.get("raw", True):
+        raise ValueError("run_design needs the output of every run, raw=False is not supported")
+    store = runner_kwargs.get("store")
+    points = [{**(base_parameters or {}), **{name: value.item() if isinstance(value, np.generic) else value
+                                             for name, value in row.items()}}
+              for row in design.to_dict("records")]
+    if groups is None:
+        results = batch_run(model_cls, points, iterations=iterations, seed=seed, **runner_kwargs)
+    else:
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        # One run per point and iteration with the seed of its group as a parameter, run r is point
+        # r % len(points) as with iterations
+        runs = [dict(point, seed=int(np.random.SeedSequence([seed, int(group), iteration]).generate_state(1)[0]))
+                for iteration in range(iterations) for point, group in zip(points, groups)]
+        results = batch_run(model_cls, runs, seed=seed, **runner_kwargs)
+    if store is not None:
+        # batch_run returns nothing with a store, the final step of the runs of this design is read back
+        final = store.read(metrics, scenario=runner_kwargs.get("scenario", "default"), step="last", params=False)
+        final = final[final["RunId"] < iterations * len(points)]
+        outputs = zip(final["RunId"].tolist(), final[metrics].to_numpy(dtype=float))
+    else:
+        outputs = ((result["RunId"], [result["columns"][metric][-1] for metric in metrics]) for result in results)
+
+    sums = np.zeros((len(points), len(metrics)))
+    counts = np.zeros((len(points), len(metrics)))
+    for run_id, values in outputs:
+        values = np.array(values, dtype=float)
+        point = run_id % len(points)
+        sums[point] += np.nan_to_num(values)
+        counts[point] += ~np.isnan(values)
+    with np.errstate(invalid="ignore"):
+        return pd.DataFrame(sums / counts, columns=metrics)
+
+
+def morris_analysis(model_cls, bounds, metrics, trajectories=10, levels=4, base_parameters=None, iterations=1,
+                    seed=None, **runner_kwargs):
+    """
+    Generates a Morris design, runs it and computes the Morris indices.
+
+    Args:
+        model_cls: The model class to analyse.
+        bounds (dict): Parameter name to (low, high), any argument of the model constructor.
+        metrics (list of str): Model reporters used as outputs.
+        trajectories, levels: See morris_design.
+        base_parameters, iterations, runner_kwargs: See run_design.
+        seed (int, optional): Seed of the design and the runs.
+
+    Returns:
+        tuple: The Morris indices, the design and the outputs.
+    """
+    design, _ = morris_design(bounds, trajectories, levels, seed)
+    # The points of a trajectory share their seeds, so the elementary effects compare equal replicates
+    groups = np.repeat(np.arange(trajectories), len(bounds) + 1)
+    outputs = run_design(model_cls, design, metrics, base_parameters, iterations, groups, seed, **runner_kwargs)
+    return morris_indices(design, outputs, bounds, trajectories), design, outputs
+
+
+def sobol_analysis(model_cls, bounds, metrics, n=64, base_parameters=None, iterations=1, seed=None,
+                   **runner_kwargs):
+    """
+    Generates a Saltelli design, runs it and computes the Sobol indices.
+
+    Args:
+        model_cls: The model class to analyse.
+        bounds (dict): Parameter name to (low, high), any argument of the model constructor.
+        metrics (list of str): Model reporters used as outputs.
+        n: See sobol_design.
+        base_parameters, iterations, runner_kwargs: See run_design.
+        seed (int, optional): Seed of the design, the runs and the bootstrap.
+
+    Returns:
+        tuple: The Sobol indices, the design and the outputs.
+    """
+    design, _ = sobol_design(bounds, n, seed)
+    # The rows of A, B and every AB_i with the same base sample share their seeds
+    groups = np.arange(len(design)) % n
+    outputs = run_design(model_cls, design, metrics, base_parameters, iterations, groups, seed, **runner_kwargs)
+    return sobol_indices(outputs, list(bounds), n, seed=seed), design, outputs
@@ -0,0 +1,168 @@
+"""
+TopologyCache.py
+
+Defines the `TopologyCache`, an on-disk cache of populations. For a given seed, the acquaintance graph,
+living areas, households, closest neighbours and bootstrapped survey rows only depend on the arguments that
+define the population (state, county, init_individuals, node_connectivity, n_neighbors, household_placement,
+stratified_bootstrap, network) and on the tract and survey data. A model created with topology_cache set
+loads its population from the cache when it was built before, so sweeps over behavioural and policy
+parameters skip building the population entirely.
+
+A population is stored as index arrays of the smallest sufficient integer type in the columnar format of
+helper_functions, and memory-mapped when loaded, so all models in a process share one copy. The graph is
+stored as its CSR adjacency matrix. The spatial index over the tracts is rebuilt when loading, it is
+cheap compared to the neighbour table.
+
+Dependencies:
+    - numpy: numerical operations
+    - scipy: adjacency matrix and spatial index
+    - networkx: graphs of the networkx network
+    - Population: the PopulationSnapshot that is cached
+    - helper_functions: columnar table format, input loaders and file fingerprints
+"""
+
+import hashlib
+import json
+import os
+import networkx as nx
+import numpy as np
+from scipy import sparse
+from scipy.spatial import KDTree
+from Population import PopulationSnapshot
+from helper_functions import file_fingerprint, load_columns, save_columns, survey_data, tract_data
+
+# Version of the population builder, cached populations of an other version are not used. Increase when
+# EvacuationDec.build_population changes the population it builds for a seed.
+TOPOLOGY_VERSION = 2
+
+
+def index_dtype(size):
+    """Smallest integer type that holds the indices 0..size."""
+    return np.int32 if size < 2 ** 31 else np.int64
+
+
+class TopologyCache:
+    def __init__(self, root):
+        """
+        Args:
+            root (str): Directory of the cache, created if it does not exist.
+        """
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def describe(seed, state, county, init_individuals, node_connectivity, n_neighbors, household_placement,
+                 stratified_bootstrap, network, rewiring_probability):
+        """
+        Returns everything the population built for a seed depends on, or None if it can not be cached
+        because the seed is not an integer.
+        """
+        if not isinstance(seed, (int, np.integer)) or isinstance(seed, bool):
+            return None
+        source = f"./ACSDATA/{[state]}{[county]}/data.gpkg"
+        survey = survey_data()
+        return {
+            "version": TOPOLOGY_VERSION,
+            "seed": int(seed),
+            "arguments": {"state": state, "county": county, "init_individuals": int(init_individuals),
+                          "node_connectivity": int(node_connectivity), "n_neighbors": int(n_neighbors),
+                          "household_placement": bool(household_placement),
+                          "stratified_bootstrap": bool(stratified_bootstrap), "network": network,
+                          "rewiring_probability": float(rewiring_probability)},
+            # The bootstrap only depends on the number of respondents of the survey tables
+            "inputs": {"tracts": file_fingerprint(source) if os.path.isfile(source) else None,
+                       "respondents": [len(survey["weights"]), len(survey["media"])]},
+        }
+
+    @staticmethod
+    def key(content):
+        """Returns the cache key of a population described by describe, the SHA-256 hash of the description."""
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        """Directory of a cached population."""
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, content):
+        """
+        Looks up a population.
+
+        Args:
+            content (dict): Description of the population, see describe.
+
+        Returns:
+            PopulationSnapshot: The cached population with memory-mapped arrays, or None on a miss.
+        """
+        columns, _ = load_columns(self.path(self.key(content)))
+        if columns is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        arguments = content["arguments"]
+        n_agents = arguments["init_individuals"]
+        indices = columns["graph.indices"]
+        G = sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, columns["graph.indptr"]),
+                              shape=(n_agents, n_agents))
+        if arguments["network"] == "networkx":
+            G = nx.from_scipy_sparse_array(G)
+
+        tracts = tract_data([arguments["state"]], [arguments["county"]])
+        tract_xy = np.column_stack([tracts["x"], tracts["y"]])
+        tract = columns["tract"]
+        agent_xy = columns["agent_xy"] if arguments["household_placement"] else tract_xy[tract]
+        return PopulationSnapshot(
+            state=arguments["state"], county=arguments["county"], n_neighbors=arguments["n_neighbors"],
+            household_placement=arguments["household_placement"], G=G, tracts=tracts, tract=tract,
+            agent_xy=agent_xy, tract_tree=KDTree(tract_xy), neighbour_table=columns["neighbour_table"],
+            survey_rows=columns["survey_rows"], media_rows=columns["media_rows"])
+
+    def put(self, content, snapshot):
+        """
+        Stores a population.
+
+        Args:
+            content (dict): Description of the population, see describe.
+            snapshot (PopulationSnapshot): The population built for it.
+        """
+        G = snapshot.G
+        if not sparse.issparse(G):
+            G = nx.to_scipy_sparse_array(G, nodelist=range(snapshot.size), format="csr")
+        dtype = index_dtype(max(snapshot.size, G.nnz))
+        columns = {
+            "graph.indptr": G.indptr.astype(dtype),
+            "graph.indices": G.indices.astype(dtype),
+            "tract": snapshot.tract.astype(index_dtype(len(snapshot.tracts["x"]))),
+            "neighbour_table": snapshot.neighbour_table.astype(dtype),
+            "survey_rows": snapshot.survey_rows.astype(dtype),
+            "media_rows": snapshot.media_rows.astype(dtype),
+        }
+        if snapshot.household_placement:
+            columns["agent_xy"] = snapshot.agent_xy
+        save_columns(self.path(self.key(content)), columns, content)
+
+    def population(self, model, seed, state, county, init_individuals, node_connectivity, n_neighbors,
+                   household_placement, stratified_bootstrap, network):
+        """
+        Returns the population of a model from the cache, building and storing it on a miss. Populations of
+        a model without an integer seed are built and not stored.
+
+        Args:
+            model (EvacuationDec): The model that builds the population on a miss.
+            seed (int): Seed of the model.
+            Other arguments: The arguments of EvacuationDec that define the population.
+
+        Returns:
+            PopulationSnapshot: The population.
+        """
+        content = self.describe(seed, state, county, init_individuals, node_connectivity, n_neighbors,
+                                household_placement, stratified_bootstrap, network, model.rewiring_probability)
+        snapshot = self.get(content) if content is not None else None
+        if snapshot is None:
+            snapshot = model.build_population(state, county, init_individuals, node_connectivity, n_neighbors,
+                                              household_placement, stratified_bootstrap=stratified_bootstrap,
+                                              network=network)
+            if content is not None:
+                self.put(content, snapshot)
+        return snapshot
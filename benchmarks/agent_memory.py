@@ -0,0 +1,61 @@
+"""agent_memory.py
+
+Measures the memory of the agent engine per agent at 1k, 100k and 1M agents: everything allocated when the
+Individual objects are created (the population itself is built beforehand and not counted). With the default
+array network the agents are not placed on a NetworkGrid. The array engine is listed for comparison, its
+state per agent are the arrays of Population.
+
+Usage:
+    python benchmarks/agent_memory.py [number of agents ...]
+
+1M agents needs about 2 GB of memory.
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+# The model loads its inputs relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from Model import EvacuationDec
+
+
+def population_bytes(population):
+    """Bytes of the per agent arrays of an array engine Population."""
+    return sum(value.nbytes for value in vars(population).values()
+               if isinstance(value, np.ndarray) and value.shape[:1] == (population.size,))
+
+
+def measure(n_agents):
+    """
+    Returns:
+        tuple: Bytes per agent of the agent engine (traced), of one Individual object and of the array engine,
+        and the seconds needed to create the agents.
+    """
+    model = EvacuationDec(engine="array", init_individuals=n_agents, seed=0, outcome_collection="convergence",
+                          run=False)
+    array_bytes = population_bytes(model.population) / n_agents
+    model.population = None
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    model.create_agents(model.population_snapshot.tract)
+    seconds = time.perf_counter() - start
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    agent = model.individuals[0]
+    object_bytes = sys.getsizeof(agent) + sys.getsizeof(vars(agent))
+    return traced / n_agents, object_bytes, array_bytes, seconds
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [1_000, 100_000, 1_000_000]
+    print(f"{'agents':>10} {'agent engine B/agent':>21} {'Individual B':>13} {'array engine B/agent':>21} {'create s':>9}")
+    for n_agents in sizes:
+        traced, object_bytes, array_bytes, seconds = measure(n_agents)
+        print(f"{n_agents:>10} {traced:>21.0f} {object_bytes:>13} {array_bytes:>21.0f} {seconds:>9.1f}")
@@ -0,0 +1,66 @@
+"""graph_generation.py
+
+Compares the build time and memory of the two acquaintance graphs of the model over population sizes:
+    - networkx: nx.watts_strogatz_graph wrapped in a mesa NetworkGrid (network="networkx")
+    - array: small_world_graph, a CSR adjacency matrix built with vectorized rewiring (network="array")
+Both include the acquaintance operator the model derives from the graph. Memory is what is still allocated
+after the build, as traced by tracemalloc; the time is measured in a separate, untraced build.
+
+Usage:
+    python benchmarks/graph_generation.py [number of agents ...]
+
+networkx at 1M agents takes minutes and several GB of memory.
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+# The helper functions load their inputs relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import networkx as nx
+import numpy as np
+from mesa.space import NetworkGrid
+from helper_functions import acquaintance_operator, small_world_graph
+
+NODE_CONNECTIVITY = 6 # Default of EvacuationDec
+REWIRING = 0.7
+
+
+def build_networkx(n_agents, seed):
+    G = nx.watts_strogatz_graph(n_agents, NODE_CONNECTIVITY, REWIRING, seed=seed)
+    return G, NetworkGrid(G), acquaintance_operator(G)
+
+
+def build_array(n_agents, seed):
+    G = small_world_graph(n_agents, NODE_CONNECTIVITY, REWIRING, np.random.default_rng(seed))
+    return G, acquaintance_operator(G)
+
+
+def measure(build, n_agents, seed=0):
+    """
+    Returns:
+        tuple: Seconds needed for the build and bytes per agent still allocated after it.
+    """
+    start = time.perf_counter()
+    build(n_agents, seed)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = build(n_agents, seed)
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return seconds, traced / n_agents
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [1_000, 10_000, 100_000, 1_000_000]
+    print(f"{'agents':>10} {'networkx s':>11} {'networkx B/agent':>17} {'array s':>8} {'array B/agent':>14}")
+    for n_agents in sizes:
+        nx_seconds, nx_bytes = measure(build_networkx, n_agents)
+        array_seconds, array_bytes = measure(build_array, n_agents)
+        print(f"{n_agents:>10} {nx_seconds:>11.2f} {nx_bytes:>17.0f} {array_seconds:>8.2f} {array_bytes:>14.0f}")
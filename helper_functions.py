@@ -1,29 +1,35 @@
+import functools
 import geopandas as gpd
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 import os
-import random
+import pickle
 import re
+import shapely
+import shutil
+import warnings
+from scipy import sparse
+from scipy.spatial import KDTree
 
-def population_bootstrapper(init_individuals,seed = None):
-    """
-    Bootstraps population data by resampling predictors and weights.
+# Read only inputs installed by the workers of BatchRunner.py. The loaders below return these instead of
+# reading the files, so all workers share one copy of the data in shared memory.
+shared_inputs = {}
 
-    Each of the predictor and weight datasets is resampled with replacement
-    to create a population of synthetic agents.
 
-    Args:
-        init_individuals (int): Number of synthetic agents to generate.
-        seed (int, optional): Seed for random number generator. If None, a random seed is used.
+@functools.lru_cache(maxsize=None)
+def survey_data():
+    """
+    Loads the survey data once per process. The tables are returned as read only numpy arrays, so
+    every model built in the same process shares them instead of reading the csv files again.
 
     Returns:
-        tuple: Three pandas.DataFrames containing resampled predictors, weights, and media weights.
+        dict: "predictors" (respondent x factor), "predictor_columns" (names of the factors),
+        "weights" (respondent x [RA, EI, ECB]) and "media" (respondent x [MD1..MD10]).
     """
-
-    # Select random number for seed
-    if seed is None:
-        rand_int = random.randint(1, 1000000)
-
-    # load survey data
+    if "survey" in shared_inputs:
+        return shared_inputs["survey"]
     predictors_df = pd.read_csv("regression models/reg_results_FINAL/preditor_data.csv")
     weights = pd.read_csv("regression models/reg_results_FINAL/weights.csv")
     media_weights = pd.read_csv("regression models/reg_results_FINAL/media_weights.csv")
@@ -33,11 +39,114 @@ def population_bootstrapper(init_individuals,seed = None):
     weights.drop(columns=weights.columns[0], inplace=True)
     media_weights.drop(columns=media_weights.columns[0], inplace=True)
 
+    data = {
+        "predictors": predictors_df.values,
+        "predictor_columns": list(predictors_df.columns),
+        "weights": weights.values,
+        "media": media_weights.values,
+    }
+    for name in ("predictors", "weights", "media"):
+        data[name].flags.writeable = False
+    return data
+
+
+@functools.lru_cache(maxsize=None)
+def load_logistic_model():
+    """Loads the logistic model for destination choice once per process."""
+    if "logistic_model" in shared_inputs:
+        return shared_inputs["logistic_model"]
+    return pickle.load(open('regression models/reg_results_FINAL/finalized_model.sav', 'rb'))
+
+
+@functools.lru_cache(maxsize=None)
+def survey_action_probabilities():
+    """
+    Probabilities of the protective actions (evac_friends, evac_hotel, evac_shelter, stay) for every
+    respondent of the survey. Bootstrapped agents are copies of respondents, so the logistic model only
+    has to be evaluated once per process.
+
+    Returns:
+        numpy.ndarray: Read only array of shape (respondent x action).
+    """
+    if "action_probabilities" in shared_inputs:
+        return shared_inputs["action_probabilities"]
+    survey = survey_data()
+    predictors = pd.DataFrame(survey["predictors"], columns=survey["predictor_columns"])
+    probabilities = load_logistic_model().predict_proba(predictors)
+    probabilities.flags.writeable = False
+    return probabilities
+
+
+def stratified_rows(rng, n_rows, size):
+    """
+    Balanced bootstrap sample: every row is a stratum that is drawn size // n_rows times, the remaining
+    size % n_rows rows are drawn without replacement. The composition of the sample therefore varies much less
+    between samples than with independent draws, while every row still has the same expected frequency.
+
+    Args:
+        rng (numpy.random.Generator): Generator for the remainder and the order.
+        n_rows (int): Number of rows to sample from.
+        size (int): Size of the sample.
+
+    Returns:
+        numpy.ndarray: Sampled row indices in random order.
+    """
+    rows = np.concatenate([np.tile(np.arange(n_rows), size // n_rows),
+                           rng.choice(n_rows, size % n_rows, replace=False)])
+    return rng.permutation(rows)
+
+
+def population_bootstrapper(init_individuals, seed=None, stratified=False):
+    """
+    Bootstraps population data by resampling respondents of the survey.
+
+    Instead of copying the survey tables, the resampled population is returned as row indices into the
+    arrays of survey_data. The predictor and weight tables describe the same respondents and share one
+    index vector. The media table has its own respondents and gets its own index vector, drawn after the
+    first one from the same generator.
+
+    Args:
+        init_individuals (int): Number of synthetic agents to generate.
+        seed (int or numpy.random.Generator, optional): Seed or generator for the resampling. If None, a
+            random seed is used.
+        stratified (bool): Uses a balanced bootstrap (see stratified_rows) instead of independent draws, which
+            reduces the variance between populations caused by the survey sample.
+
+    Returns:
+        tuple: Row indices into the predictor and weight tables, and row indices into the media table.
+    """
+    rng = np.random.default_rng(seed)
+    survey = survey_data()
+
+    if stratified:
+        survey_rows = stratified_rows(rng, len(survey["weights"]), init_individuals)
+        media_rows = stratified_rows(rng, len(survey["media"]), init_individuals)
+        return survey_rows, media_rows
+
     # Resample init_individuals agents with bootstrap
-    resampled_factors = predictors_df.sample(n=init_individuals,replace=True,random_state=rand_int).reset_index(drop=True)
-    resampled_weights = weights.sample(n=init_individuals, replace=True, random_state=rand_int).reset_index(drop=True)
-    resampled_media_weights = media_weights.sample(n=init_individuals, replace=True, random_state=rand_int).reset_index(drop=True)
-    return resampled_factors, resampled_weights, resampled_media_weights
+    survey_rows = rng.choice(len(survey["weights"]), size=init_individuals, replace=True)
+    media_rows = rng.choice(len(survey["media"]), size=init_individuals, replace=True)
+    return survey_rows, media_rows
+
+
+# Stochastic parts of the model. Every part draws from its own stream, spawned from the seed of the model, so
+# changing how much one part draws does not change the others. New streams must be added at the end.
+RNG_STREAMS = ("graph", "placement", "neighbours", "bootstrap", "decisions", "schedule")
+
+
+def spawn_streams(seed=None):
+    """
+    Spawns the independent random streams of a model from one seed.
+
+    Args:
+        seed (int or numpy.random.SeedSequence, optional): Seed of the model. If None, fresh entropy is used.
+
+    Returns:
+        dict: Name of every stream in RNG_STREAMS to its numpy.random.Generator.
+    """
+    sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    children = sequence.spawn(len(RNG_STREAMS))
+    return {name: np.random.default_rng(child) for name, child in zip(RNG_STREAMS, children)}
 
 def shift_watch_warning(warning_list, timing=0, gap=0, fill_value=0):
     """
@@ -122,6 +231,8 @@ def retrieve_wind_cue(model):
     Calculates the mean wind cue among agents within the model. Used by the
     datacollector in the model class
     """
+    if model.engine == "array":
+        return model.population.get("wind_cue").mean()
     values = model.agents.get("wind_cue")
     return sum(values)/len(values)
 
@@ -130,6 +241,8 @@ def retrieve_rain_cue(model):
     Calculates the mean rain cue among agents within the model. Used by the
     datacollector in the model class
     """
+    if model.engine == "array":
+        return model.population.get("rain_cue").mean()
     values = model.agents.get("rain_cue")
     return sum(values)/len(values)
 
@@ -210,19 +323,355 @@ def parse_np_float_string(val):
     return [float(x.strip()) for x in cleaned.strip('[]').split(',') if x.strip()]
 
 
-def closest_neighbours(model, id,nn):
+def file_fingerprint(path):
+    """
+    Returns the SHA-256 content hash of a file. Hashes are remembered per process for as long as the
+    size and modification time of the file do not change, so repeated calls do not read the file again.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        str: Hexadecimal SHA-256 digest of the file contents.
+    """
+    stat = os.stat(path)
+    return _file_fingerprint(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _file_fingerprint(path, size, mtime):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_columns(directory, columns, meta):
+    """
+    Stores arrays as a binary columnar table: one .npy file per column plus a manifest.json with
+    metadata. The table is written to a temporary directory first and moved in place afterwards,
+    so readers never see a half written table.
+
+    Args:
+        directory (str): Directory of the table.
+        columns (dict): Column name to numpy.ndarray.
+        meta (dict): JSON serializable metadata, e.g. the hash of the source the table was made from.
+    """
+    tmp = f"{directory}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(values))
+    with open(os.path.join(tmp, "manifest.json"), "w") as file:
+        json.dump({"columns": list(columns), "meta": meta}, file)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    try:
+        os.replace(tmp, directory)
+    except OSError:
+        # Another process wrote the same table in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(directory):
+            raise
+
+
+def load_columns(directory, mmap=True):
+    """
+    Loads a table written by save_columns.
+
+    Args:
+        directory (str): Directory of the table.
+        mmap (bool): Memory-map the columns read only instead of reading them into memory.
+
+    Returns:
+        tuple: Dictionary of column name to numpy.ndarray and the metadata, or (None, None) if the
+        table does not exist.
+    """
+    manifest = os.path.join(directory, "manifest.json")
+    if not os.path.isfile(manifest):
+        return None, None
+    with open(manifest) as file:
+        content = json.load(file)
+    columns = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None)
+               for name in content["columns"]}
+    return columns, content["meta"]
+
+
+# Columns stored in the tract cache, caches missing one of them are rebuilt
+TRACT_COLUMNS = ("x", "y", "PopDense", "wind", "rain", "storm_surge", "bounds", "wkb", "wkb_offsets")
+
+
+def tract_data(state, county):
+    """
+    Returns the tract data the model uses: centroid coordinates, population densities and the wind,
+    rain and storm surge cues as dense (tract x timestep) arrays. The arrays are cached as a binary
+    columnar table in a cache folder next to data.gpkg and memory-mapped when loaded. The cache is
+    rebuilt when the content hash of data.gpkg changes, so the GPKG is only parsed once.
+
+    Args:
+        state (str or list of str): State abbreviation(s).
+        county (str or list of str): County name(s) or code(s).
+
+    Returns:
+        dict: Arrays "x", "y", "PopDense", "wind", "rain" and "storm_surge", one row per tract. The tract
+        polygons are stored as "bounds" (tract x [minx, miny, maxx, maxy]) and as WKB in "wkb", where the
+        polygon of tract t is wkb[wkb_offsets[t]:wkb_offsets[t + 1]].
+    """
+    if ("tracts", f"{state}{county}") in shared_inputs:
+        return shared_inputs[("tracts", f"{state}{county}")]
+    source = f"./ACSDATA/{state}{county}/data.gpkg"
+    cache = f"./ACSDATA/{state}{county}/cache"
+    if os.path.isfile(source):
+        columns, meta = load_columns(cache)
+        if (columns is not None and set(TRACT_COLUMNS) <= set(columns)
+                and meta["source_hash"] == file_fingerprint(source)):
+            return columns
+
+    init_data = agent_init_data(state, county)
+    centroids = init_data["geometry"].centroid
+    columns = {
+        "x": centroids.x.values,
+        "y": centroids.y.values,
+        "PopDense": init_data["PopDense"].values,
+        "wind": np.array(init_data["WindCat"].apply(parse_np_float_string).tolist()),
+        "rain": np.array(init_data["RainCat"].apply(parse_np_float_string).tolist()),
+        "storm_surge": np.array(init_data["storm_Surge"].apply(parse_np_float_string).tolist()),
+        "bounds": init_data["geometry"].bounds.values,
+    }
+    wkb = [np.frombuffer(polygon, dtype=np.uint8) for polygon in shapely.to_wkb(init_data["geometry"].values)]
+    columns["wkb"] = np.concatenate(wkb)
+    columns["wkb_offsets"] = np.concatenate([[0], np.cumsum([len(polygon) for polygon in wkb])])
+    save_columns(cache, columns, {"source_hash": file_fingerprint(source)})
+    return load_columns(cache)[0]
+
+
+def neighbour_table(coords, nn):
+    """
+    Finds the closest neighbours of all agents with a single KD-tree query.
+
+    Every agent is queried for nn + 1 points and the agent itself is removed from its own row. When
+    agents share a location, the agent itself can be missing from the result; the furthest point is
+    then dropped instead, so every agent gets exactly nn neighbours.
+
+    Args:
+        coords (numpy.ndarray): Location of every agent (agent x 2).
+        nn (int): Number of neighbors to find.
+
+    Returns:
+        tuple: The KDTree over coords and the neighbour table, an integer array (agent x nn)
+        holding the agent indices of the closest neighbours.
+    """
+    tree = KDTree(coords)
+    idx = tree.query(coords, k=nn + 1)[1]
+    own = idx == np.arange(len(coords))[:, None]
+    own[~own.any(axis=1), -1] = True
+    return tree, idx[~own].reshape(len(coords), nn)
+
+
+def household_positions(tract, tracts, rng):
+    """
+    Samples a household location for every agent inside the polygon of its tract. Points are drawn
+    uniformly within the bounds of the tract and rejected when they fall outside the polygon.
+
+    Args:
+        tract (numpy.ndarray): Tract index of every agent.
+        tracts (dict): Tract data as returned by tract_data.
+        rng (numpy.random.Generator): Random number generator used for sampling.
+
+    Returns:
+        numpy.ndarray: Household location of every agent (agent x 2).
     """
-    Finds the nearest neighbors for a given agent
-    by unique id using KD-tree defined in the model.
+    positions = np.empty((len(tract), 2))
+    order = np.argsort(tract, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(np.bincount(tract, minlength=len(tracts["x"])))])
+    offsets = tracts["wkb_offsets"]
+    for t in np.flatnonzero(np.diff(starts)):
+        members = order[starts[t]:starts[t + 1]]
+        polygon = shapely.from_wkb(tracts["wkb"][offsets[t]:offsets[t + 1]].tobytes())
+        minx, miny, maxx, maxy = tracts["bounds"][t]
+        found = 0
+        while found < len(members):
+            draws = 2 * (len(members) - found) + 16
+            x = rng.uniform(minx, maxx, draws)
+            y = rng.uniform(miny, maxy, draws)
+            inside = shapely.contains_xy(polygon, x, y)
+            points = np.column_stack([x[inside], y[inside]])[:len(members) - found]
+            positions[members[found:found + len(points)]] = points
+            found += len(points)
+    return positions
+
+
+def tract_neighbour_table(tract, tract_xy, nn, rng, agent_xy=None):
+    """
+    Finds the closest neighbours of all agents through a spatial index over the tract centroids.
+    For every tract, the nearest tracts are looked up first until they hold enough agents, and the
+    neighbours are then chosen among the agents of those candidate tracts only.
+
+    Without household locations all agents of a tract share the centroid, so every agent is at the
+    same distance from the others in its tract. These ties are resolved at random instead of by the
+    arbitrary order of a KD-tree: the agents of a tract are shuffled and every agent gets the agents
+    that follow it in the shuffled order, completed with agents of the nearest other tracts. With
+    household locations, the candidate tracts also include every tract close enough to hold a closer
+    household, and the neighbours are the closest candidates by their actual distance.
 
     Args:
-        model: A model object, must have 'pos_dict', 'tree', and 'tree.data'.
-        id (int): Unique ID of the agent whose neighbors are to be found.
+        tract (numpy.ndarray): Tract index of every agent.
+        tract_xy (numpy.ndarray): Centroid of every tract (tract x 2).
         nn (int): Number of neighbors to find.
+        rng (numpy.random.Generator): Random number generator used to resolve ties.
+        agent_xy (numpy.ndarray, optional): Household location of every agent (agent x 2).
+
+    Returns:
+        tuple: The KDTree over the tract centroids and the neighbour table, an integer array
+        (agent x nn) holding the agent indices of the closest neighbours.
+    """
+    tract_tree = KDTree(tract_xy)
+    counts = np.bincount(tract, minlength=len(tract_xy))
+    # Agents grouped per tract, in random order within their tract
+    order = rng.permutation(len(tract))
+    order = order[np.argsort(tract[order], kind="stable")]
+    starts = np.concatenate([[0], np.cumsum(counts)])
+
+    if agent_xy is not None:
+        # Largest distance between a household and the centroid of its tract
+        radius = np.zeros(len(tract_xy))
+        np.maximum.at(radius, tract, np.linalg.norm(agent_xy - tract_xy[tract], axis=1))
+
+    def candidate_tracts(t):
+        # Nearest tracts, own tract first, until they hold the agent and nn others
+        k = 1
+        while True:
+            distance, near = tract_tree.query(tract_xy[t], k=min(k, len(tract_xy)))
+            near = np.atleast_1d(near)
+            if counts[near].sum() > nn or k >= len(tract_xy):
+                break
+            k *= 2
+        if agent_xy is not None:
+            # Any tract that can hold a household closer than the households found so far is a candidate too
+            reach = np.max(distance) + 2 * radius[t] + 2 * radius.max()
+            near = np.array(tract_tree.query_ball_point(tract_xy[t], reach, return_sorted=True))
+        return np.concatenate([[t], near[near != t]])
+
+    table = np.empty((len(tract), nn), dtype=np.int64)
+    for t in np.flatnonzero(counts):
+        members = order[starts[t]:starts[t + 1]]
+        candidates = np.concatenate([order[starts[c]:starts[c + 1]] for c in candidate_tracts(t)])
+        if agent_xy is None:
+            own = min(nn, len(members) - 1)
+            following = (np.arange(len(members))[:, None] + np.arange(1, own + 1)) % len(members)
+            table[members, :own] = members[following]
+            # The remaining neighbours come from the nearest other tracts, which are equally far for all members
+            table[members, own:] = candidates[len(members):len(members) + nn - own]
+        else:
+            # The candidates start with the members of the tract itself
+            local = neighbour_table(agent_xy[candidates], nn)[1][:len(members)]
+            table[members] = candidates[local]
+    return tract_tree, table
+
+
+def communication_operator(senders, receivers, n_agents):
+    """
+    Builds a CSR operator for communication between agents. Row i holds the agents that receive
+    what agent i communicates, so the rows of a group of senders can be sliced cheaply.
+
+    Args:
+        senders (numpy.ndarray): Agent index of the sender of every edge.
+        receivers (numpy.ndarray): Agent index of the receiver of every edge.
+        n_agents (int): Number of agents in the population.
+
+    Returns:
+        scipy.sparse.csr_matrix: Sender x receiver operator with a one for every edge.
+    """
+    return sparse.csr_matrix((np.ones(len(senders)), (senders, receivers)), shape=(n_agents, n_agents))
+
+
+def prune_operator(operator, keep):
+    """
+    Removes the edges from and to the agents that are not kept from a communication operator. The shape and
+    agent indices are unchanged.
+
+    Args:
+        operator (scipy.sparse.csr_matrix): Sender x receiver operator.
+        keep (numpy.ndarray): Boolean mask of the agents to keep.
+
+    Returns:
+        scipy.sparse.csr_matrix: The pruned operator.
+    """
+    mask = sparse.diags(keep.astype(operator.dtype))
+    pruned = (mask @ operator @ mask).tocsr()
+    pruned.eliminate_zeros()
+    return pruned
+
+
+def small_world_graph(n, k, p, rng):
+    """
+    Array counterpart of networkx.watts_strogatz_graph. Builds the ring lattice in which every node is
+    joined to its k // 2 nearest nodes on both sides, and rewires every lattice edge (u, u + j) with
+    probability p to (u, w), with w drawn uniformly. As in networkx, an edge keeps its position until a target
+    is found that forms no self loop and no edge that exists, and the edges of a node that is joined to all
+    other nodes are not rewired. The targets are drawn for all pending edges at once, and drawn again for the
+    rejected ones.
+
+    Args:
+        n (int): Number of nodes.
+        k (int): Number of nearest nodes every node is joined to in the ring lattice.
+        p (float): Probability of rewiring an edge.
+        rng (numpy.random.Generator): Generator for the rewiring.
+
+    Returns:
+        scipy.sparse.csr_matrix: Symmetric (n x n) adjacency matrix of the graph.
+    """
+    if k > n:
+        raise ValueError("k > n, choose smaller k or larger n")
+    if k == n or 2 * (k // 2) >= n - 1:
+        # Every node is joined to all others, nothing can be rewired
+        return sparse.csr_matrix(np.ones((n, n), dtype=np.int8) - np.eye(n, dtype=np.int8))
+    source = np.tile(np.arange(n), k // 2)
+    target = (source + np.repeat(np.arange(1, k // 2 + 1), n)) % n
+
+    def edge_key(u, v):
+        return np.minimum(u, v).astype(np.int64) * n + np.maximum(u, v)
+
+    pending = np.flatnonzero(rng.random(len(source)) < p)
+    for _ in range(100):
+        # Edges of nodes that are joined to all other nodes have no free target
+        degree = np.bincount(source, minlength=n) + np.bincount(target, minlength=n)
+        pending = pending[degree[source[pending]] < n - 1]
+        if not len(pending):
+            break
+        candidate = rng.integers(n, size=len(pending))
+        key = edge_key(source[pending], candidate)
+        # A candidate is accepted if it is no self loop, no existing edge and the first draw of its edge
+        accepted = (candidate != source[pending]) & ~np.isin(key, edge_key(source, target))
+        first = np.zeros(len(key), dtype=bool)
+        first[np.unique(key, return_index=True)[1]] = True
+        accepted &= first
+        target[pending[accepted]] = candidate[accepted]
+        pending = pending[~accepted]
+    else:
+        warnings.warn(f"small_world_graph kept {len(pending)} edges at their lattice position, no free target "
+                      f"was drawn for them in 100 rounds")
+
+    return sparse.csr_matrix((np.ones(2 * len(source), dtype=np.int8),
+                              (np.concatenate([source, target]), np.concatenate([target, source]))),
+                             shape=(n, n))
+
+
+def acquaintance_operator(graph):
+    """
+    Turns the Watts Strogatz graph into a CSR communication operator. When the agent engine places its
+    agents on the NetworkGrid, an agent only finds the acquaintances that were placed before it. Agents
+    therefore only communicate with acquaintances with a lower node id, which the operator mirrors.
+
+    Args:
+        graph (networkx.Graph or scipy.sparse.csr_matrix): Acquaintance graph with nodes 0..n-1, or its
+            symmetric adjacency matrix as built by small_world_graph.
 
     Returns:
-        list: List of agent objects for the nearest neighbors, excluding the agent itself.
+        scipy.sparse.csr_matrix: Sender x receiver operator of the acquaintance graph.
     """
-    a = [list(model.pos_dict.keys())[uq_id] for uq_id in
-         model.tree.query(model.tree.data[list(model.pos_dict.keys())[id-1].unique_id - 1], k=nn + 1)[1]]
-    return [i for i in a if i.unique_id != id]
\ No newline at end of file
+    if sparse.issparse(graph):
+        lower = sparse.tril(graph, k=-1, format="csr")
+        return sparse.csr_matrix((np.ones(lower.nnz), lower.indices, lower.indptr), shape=lower.shape)
+    edges = np.array(graph.edges, dtype=int).reshape(-1, 2)
+    return communication_operator(edges.max(axis=1), edges.min(axis=1), graph.number_of_nodes())